@@ -0,0 +1,134 @@
+"""
+Benchmark m_active and m_itemlog polls end to end against a synthetic database.
+Each monitor is set up and polled through its runner plugin entry points
+against the SQLite stand-in of aegis_db, populated and advanced every poll
+by fake_aegis, in a fresh process per database size.
+Reports per-poll CPU and wall time (query and processing), /metrics scrape
+time and size, and peak RSS for 1k, 10k, and 100k characters.
+Requires the m_active and m_itemlog dependencies, run from the repository root:
+    python3 benchmarks/bench_monitors.py
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS, '..', 'm_itemlog'))
+sys.path.insert(0, os.path.join(BENCHMARKS, '..', 'm_active'))
+sys.path.insert(0, os.path.join(BENCHMARKS, '..', 'm_common'))
+import prometheus_client  # noqa: E402
+import aegis_db  # noqa: E402
+import monitor_active  # noqa: E402
+import monitor_itemlog  # noqa: E402
+import fake_aegis  # noqa: E402
+
+
+# Monitor setup arguments, m_itemlog polls incrementally with its watermark in the database directory
+MONITORS = {
+    'active': (monitor_active, {
+        'poll_interval': 60,
+        'poll_phase': 0,
+        'sync_probes': 0,
+        'delta_mode': False,
+        'state_file': '',
+        'state_interval': 0,
+        'log_verbosity': 'summary',
+        'log_top_n': 10,
+        'log_anomaly_threshold': 12,
+        'pipeline': False,
+        'query_timeout': 0,
+        'breaker_failures': 0,
+        'breaker_reset': 0
+        }),
+    'itemlog': (monitor_itemlog, {
+        'poll_interval': 60,
+        'poll_phase': 0,
+        'batch_size': 5000,
+        'watermark_file': 'watermark.json',
+        'eviction_ttl': 0,
+        'eviction_max_characters': 0,
+        'drop_zero': False,
+        'state_file': '',
+        'state_interval': 0,
+        'log_verbosity': 'summary',
+        'log_top_n': 10,
+        'log_anomaly_threshold': 100,
+        'pipeline': False,
+        'query_timeout': 0,
+        'breaker_failures': 0,
+        'breaker_reset': 0
+        })
+    }
+
+
+def benchmark(monitor, characters, activity, actions, polls, collector_mode):
+    """
+    Return mean CPU and wall seconds per poll, mean scrape seconds, scrape
+    bytes, and peak RSS bytes of monitor polling a synthetic database.
+    """
+    logging.disable(logging.INFO)
+    with tempfile.TemporaryDirectory() as directory:
+        database = os.path.join(directory, 'aegis.db')
+        fake = fake_aegis.create(database, characters)
+        module, config = MONITORS[monitor]
+        if 'watermark_file' in config:
+            config = dict(config, watermark_file=os.path.join(directory, config['watermark_file']))
+        pool = aegis_db.ConnectionPool(
+            driver='sqlite',
+            server=None,
+            username=None,
+            password=None,
+            database=database
+            )
+        state = module.PLUGIN['setup'](pool=pool, collector_mode=collector_mode, **config)
+
+        time_cpu, time_wall, time_scrape = 0, 0, 0
+        for _ in range(polls):
+            fake_aegis.advance(fake, characters, activity, actions)
+
+            cpu_start, wall_start = time.process_time(), time.perf_counter()
+            module.PLUGIN['poll'](state)
+            time_cpu += time.process_time() - cpu_start
+            time_wall += time.perf_counter() - wall_start
+
+            time_start = time.perf_counter()
+            scrape = prometheus_client.generate_latest()
+            time_scrape += time.perf_counter() - time_start
+        fake.close()
+
+    # ru_maxrss is reported in KiB on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return time_cpu / polls, time_wall / polls, time_scrape / polls, len(scrape), peak_rss
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    PARSER.add_argument('--monitors', nargs='+', choices=list(MONITORS), default=list(MONITORS))
+    PARSER.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    PARSER.add_argument('--activity', type=float, default=0.05, help='fraction of characters changed per poll')
+    PARSER.add_argument('--actions', type=int, default=5, help='itemlog actions per changed character')
+    PARSER.add_argument('--polls', type=int, default=5)
+    PARSER.add_argument('--collector', action='store_true', help='render metrics at scrape time (COLLECTOR_MODE)')
+    ARGS = PARSER.parse_args()
+
+    # A fresh process per run, so peak RSS is not carried over between sizes
+    CONTEXT = multiprocessing.get_context('spawn')
+    print('{:>8} {:>10} {:>10} {:>10} {:>11} {:>12} {:>9}'.format(
+        'monitor', 'characters', 'cpu (ms)', 'wall (ms)', 'scrape (ms)', 'scrape (KiB)', 'rss (MiB)'
+        ))
+    for MONITOR in ARGS.monitors:
+        for SIZE in ARGS.sizes:
+            with CONTEXT.Pool(1) as POOL:
+                RESULT = POOL.apply(
+                    benchmark,
+                    (MONITOR, SIZE, ARGS.activity, ARGS.actions, ARGS.polls, ARGS.collector)
+                    )
+            print('{:>8} {:>10} {:>10.1f} {:>10.1f} {:>11.1f} {:>12.0f} {:>9.1f}'.format(
+                MONITOR, SIZE, RESULT[0] * 1000, RESULT[1] * 1000, RESULT[2] * 1000,
+                RESULT[3] / 1024, RESULT[4] / 2 ** 20
+                ))
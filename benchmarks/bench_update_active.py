@@ -0,0 +1,135 @@
+"""
+Benchmark m_active poll processing against synthetic character snapshots.
+Reports gen_snapshot and update_active (with update_gauges) time per poll for
+10k, 100k, and 1M characters.  Gauges are replaced with no-op stand-ins so
+only the monitor's own processing is measured, pass --gauges to include
+prometheus_client.
+Requires the m_active dependencies, run from the repository root:
+    python3 benchmarks/bench_update_active.py
+"""
+import argparse
+import datetime
+import logging
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'm_active'))
+import prometheus_client  # noqa: E402
+import monitor_active  # noqa: E402
+import charinfo_store  # noqa: E402
+import poll_scheduler  # noqa: E402
+
+MAPS = ['prontera.gat', 'geffen.gat', 'payon.gat', 'morocc.gat', 'prt_fild08.gat', 'gef_dun01.gat']
+
+
+class NullGauge:
+    """
+    Gauge stand-in that discards every update.
+    """
+    def labels(self, **labels):
+        return self
+
+    def set(self, value):
+        pass
+
+
+def gen_gauges(real):
+    """
+    Return a monitor_active gauges dictionary.
+    """
+    if not real:
+        gauge = NullGauge()
+        return {
+            'active': {'map': gauge, 'character': gauge},
+            'info': {field: gauge for field in ['base_level', 'job_level', 'stat_points', 'skill_points', 'money']}
+            }
+
+    registry = prometheus_client.CollectorRegistry()
+    return {
+        'active': {
+            'map': prometheus_client.Gauge('character_population', '', ['map_name'], registry=registry),
+            'character': prometheus_client.Gauge('character_active', '', ['character', 'email'], registry=registry)
+            },
+        'info': {
+            field: prometheus_client.Gauge('character_' + field, '', labelnames, registry=registry)
+            for field, labelnames in [
+                ('base_level', ['character']),
+                ('job_level', ['character']),
+                ('stat_points', ['character']),
+                ('skill_points', ['character']),
+                ('money', ['character', 'email'])
+                ]
+            }
+        }
+
+
+def gen_results(characters):
+    """
+    Return synthetic rocp_admin_charinfo_db rows.
+    """
+    return [
+        [
+            'char{}'.format(gid), random.choice(MAPS), random.randrange(400), random.randrange(400),
+            gid, gid // 3, 4009, 90, 50, 0, 0, 1000000, 500000, 10000, 'char{}@example.com'.format(gid)
+            ]
+        for gid in range(characters)
+        ]
+
+
+def mutate_results(results, activity):
+    """
+    Move a random 'activity' fraction of characters.
+    """
+    for result in random.sample(results, int(len(results) * activity)):
+        result[1] = random.choice(MAPS)
+        result[2] = random.randrange(400)
+        result[11] += random.randrange(1, 1000)
+
+
+def benchmark(characters, activity, polls, real_gauges):
+    """
+    Return mean snapshot and update_active seconds per poll.
+    """
+    gauges = gen_gauges(real_gauges)
+    results = gen_results(characters)
+    charinfo_active, mapinfo_active = monitor_active.initialize_active(
+        charinfo_db=charinfo_store.gen_snapshot(results),
+        gauges=gauges
+        )
+
+    time_snapshot, time_update = 0, 0
+    for _ in range(polls):
+        mutate_results(results, activity)
+
+        time_start = time.perf_counter()
+        charinfo_db = charinfo_store.gen_snapshot(results)
+        time_snapshot += time.perf_counter() - time_start
+
+        time_start = time.perf_counter()
+        charinfo_active, mapinfo_active, updated = monitor_active.update_active(
+            charinfo_active=charinfo_active,
+            mapinfo_active=mapinfo_active,
+            charinfo_db=charinfo_db,
+            epochs=poll_scheduler.window_epochs(datetime.datetime.now())
+            )
+        monitor_active.update_gauges(charinfo_active, mapinfo_active, updated, gauges)
+        time_update += time.perf_counter() - time_start
+
+    return time_snapshot / polls, time_update / polls
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    PARSER.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    PARSER.add_argument('--activity', type=float, default=0.05, help='fraction of characters changed per poll')
+    PARSER.add_argument('--polls', type=int, default=5)
+    PARSER.add_argument('--gauges', action='store_true', help='update real prometheus_client gauges')
+    ARGS = PARSER.parse_args()
+
+    logging.disable(logging.INFO)
+    print('{:>10} {:>14} {:>14}'.format('characters', 'snapshot (ms)', 'update (ms)'))
+    for SIZE in ARGS.sizes:
+        TIME_SNAPSHOT, TIME_UPDATE = benchmark(SIZE, ARGS.activity, ARGS.polls, ARGS.gauges)
+        print('{:>10} {:>14.1f} {:>14.1f}'.format(SIZE, TIME_SNAPSHOT * 1000, TIME_UPDATE * 1000))
@@ -0,0 +1,92 @@
+"""
+Synthetic Aegis database for running and benchmarking the monitors locally.
+Populates a SQLite database with the stand-in tables of aegis_db, and
+advances it every poll by moving a fraction of characters and logging
+itemlog actions for them.  Point a monitor at it with DB_DRIVER=sqlite and
+DB_DATABASE set to the database file, run from the repository root:
+    python3 benchmarks/fake_aegis.py aegis.db --characters 10000 --interval 60
+"""
+import argparse
+import datetime
+import logging
+import os
+import random
+import sqlite3
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'm_common'))
+import aegis_db  # noqa: E402
+
+MAPS = ['prontera.gat', 'geffen.gat', 'payon.gat', 'morocc.gat', 'prt_fild08.gat', 'gef_dun01.gat']
+JOBS = list(range(0, 24))
+ACTIONS = list(range(0, 25)) + [35, 36]
+
+
+def create(database, characters):
+    """
+    Create database with 'characters' characters and an empty ItemLog, and return its connection.
+    """
+    connection = sqlite3.connect(database)
+    connection.executescript(aegis_db.SQLITE_SCHEMA)
+    connection.execute('DELETE FROM charinfo')
+    connection.execute('DELETE FROM ItemLog')
+    connection.executemany(
+        'INSERT INTO charinfo VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        (
+            (
+                'char{}'.format(gid), random.choice(MAPS), random.randrange(400), random.randrange(400),
+                gid, gid // 3, random.choice(JOBS), random.randrange(1, 100), random.randrange(1, 70),
+                0, 0, random.randrange(10000000), random.randrange(5000000), random.randrange(1000000),
+                'account{}@example.com'.format(gid // 3)
+                )
+            for gid in range(characters)
+            )
+        )
+    connection.commit()
+    return connection
+
+
+def advance(connection, characters, activity, actions):
+    """
+    Move a random 'activity' fraction of characters, gaining experience and
+    money, and log 'actions' random itemlog actions for each.
+    """
+    gids = random.sample(range(characters), int(characters * activity))
+    connection.executemany(
+        'UPDATE charinfo SET mapname = ?, xPos = ?, yPos = ?, exp = exp + ?, money = money + ? WHERE GID = ?',
+        (
+            (random.choice(MAPS), random.randrange(400), random.randrange(400),
+             random.randrange(1, 1000), random.randrange(-100, 100), gid)
+            for gid in gids
+            )
+        )
+
+    logtime = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    connection.executemany(
+        'INSERT INTO ItemLog (logtime, srcCharName, srcCharID, srcAccountID, Action) VALUES (?, ?, ?, ?, ?)',
+        (
+            (logtime, 'char{}'.format(gid), gid, gid // 3, random.choice(ACTIONS))
+            for gid in gids
+            for _ in range(actions)
+            )
+        )
+    connection.commit()
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    PARSER.add_argument('database', help='SQLite database file, recreated on start')
+    PARSER.add_argument('--characters', type=int, default=10000)
+    PARSER.add_argument('--activity', type=float, default=0.05, help='fraction of characters changed per interval')
+    PARSER.add_argument('--actions', type=int, default=5, help='itemlog actions per changed character')
+    PARSER.add_argument('--interval', type=int, default=60, help='seconds between database updates')
+    ARGS = PARSER.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+    CONNECTION = create(ARGS.database, ARGS.characters)
+    logging.info('Created %s with %s characters', ARGS.database, ARGS.characters)
+    while True:
+        time.sleep(ARGS.interval)
+        advance(CONNECTION, ARGS.characters, ARGS.activity, ARGS.actions)
+        logging.info('Advanced %s characters', int(ARGS.characters * ARGS.activity))
@@ -0,0 +1,203 @@
+"""
+Columnar character state store for m_active.
+Each character is assigned a stable row index, and every numeric field is
+kept in a typed array indexed by that row rather than a per-character
+nested dict.  Map names are interned to integer ids.
+"""
+import operator
+from array import array
+
+# Field typecodes, in rocp_admin_charinfo_db column order where applicable
+POSITION_FIELDS = ('map', 'xPos', 'yPos')
+ID_FIELDS = ('GID', 'AID')
+INFO_FIELDS = (
+    'job', 'base_level', 'job_level', 'stat_points', 'skill_points', 'exp', 'jobexp', 'money'
+    )
+ACTIVE_FIELDS = ('week', 'day', 'hour', 'consecutive', 'now')
+WINDOW_FIELDS = ('week', 'day', 'hour')
+TRACKED_FIELDS = POSITION_FIELDS + INFO_FIELDS
+SNAPSHOT_FIELDS = (
+    'name', 'mapname', 'xPos', 'yPos', 'GID', 'AID', 'job', 'base_level', 'job_level',
+    'stat_points', 'skill_points', 'exp', 'jobexp', 'money', 'email'
+    )
+TYPECODES = {
+    'map': 'i',
+    'xPos': 'i',
+    'yPos': 'i',
+    'GID': 'q',
+    'AID': 'q',
+    'job': 'i',
+    'base_level': 'i',
+    'job_level': 'i',
+    'stat_points': 'i',
+    'skill_points': 'i',
+    'exp': 'q',
+    'jobexp': 'q',
+    'money': 'q',
+    'week': 'i',
+    'day': 'i',
+    'hour': 'i',
+    'consecutive': 'i',
+    'now': 'b',
+    'week_epoch': 'i',
+    'day_epoch': 'i',
+    'hour_epoch': 'i'
+    }
+
+# Persisted state schema version, increment whenever CharinfoStore attributes or TYPECODES change
+STATE_VERSION = 1
+
+
+def gen_snapshot(results):
+    """
+    Transpose rocp_admin_charinfo_db rows into a columnar snapshot, one tuple per field.
+    """
+    if not results:
+        return {field: () for field in SNAPSHOT_FIELDS}
+    return dict(zip(SNAPSHOT_FIELDS, zip(*results)))
+
+
+class CharinfoStore:
+    """
+    Character state with one typed array per field and one row per character.
+    Rows of deleted characters are recycled for new characters.
+    """
+    def __init__(self):
+        self.rows = {}
+        self.names = []
+        self.emails = []
+        self.free = []
+        self.map_ids = {}
+        self.map_names = []
+        self.columns = {field: array(typecode) for field, typecode in TYPECODES.items()}
+
+    @classmethod
+    def from_state(cls, state):
+        """
+        Return a store restored from state.
+        """
+        store = cls()
+        store.rows = state['rows']
+        store.names = state['names']
+        store.emails = state['emails']
+        store.free = state['free']
+        store.map_ids = state['map_ids']
+        store.map_names = state['map_names']
+        store.columns = state['columns']
+        return store
+
+    def state(self):
+        """
+        Return the store as plain containers for persistence, typed columns
+        are kept as arrays and serialized as raw bytes.
+        """
+        return {
+            'rows': self.rows,
+            'names': self.names,
+            'emails': self.emails,
+            'free': self.free,
+            'map_ids': self.map_ids,
+            'map_names': self.map_names,
+            'columns': self.columns
+            }
+
+    def __len__(self):
+        return len(self.rows)
+
+    def map_id(self, map_name):
+        """
+        Return the interned id of map_name.
+        """
+        try:
+            return self.map_ids[map_name]
+        except KeyError:
+            self.map_ids[map_name] = len(self.map_names)
+            self.map_names.append(map_name)
+            return self.map_ids[map_name]
+
+    def add(self, character, snapshot, index):
+        """
+        Add entry 'index' of snapshot as a new character and return its row index.
+        """
+        if self.free:
+            row = self.free.pop()
+            self.names[row] = character
+            self.emails[row] = snapshot['email'][index]
+            for field in ACTIVE_FIELDS:
+                self.columns[field][row] = 0
+        else:
+            row = len(self.names)
+            self.names.append(character)
+            self.emails.append(snapshot['email'][index])
+            for field in TYPECODES:
+                self.columns[field].append(0)
+
+        self.rows[character] = row
+        self.columns['GID'][row] = snapshot['GID'][index]
+        self.columns['AID'][row] = snapshot['AID'][index]
+        self.set_tracked(row, snapshot, index)
+        return row
+
+    def remove(self, character):
+        """
+        Remove character, freeing its row for reuse.
+        """
+        row = self.rows.pop(character)
+        self.names[row] = None
+        self.emails[row] = None
+        self.free.append(row)
+        for field in ACTIVE_FIELDS:
+            self.columns[field][row] = 0
+
+    def set_tracked(self, row, snapshot, index):
+        """
+        Store tracked (position, info) values of snapshot entry 'index' in row.
+        """
+        self.columns['map'][row] = self.map_id(snapshot['mapname'][index])
+        for field in TRACKED_FIELDS[1:]:
+            self.columns[field][row] = snapshot[field][index]
+
+    def detect_changes(self, snapshot):
+        """
+        Return the store row of each snapshot entry, and a mask of the entries
+        whose tracked values differ from the store.  Every field is compared
+        for all characters in one pass over its column.
+        """
+        order = list(map(self.rows.__getitem__, snapshot['name']))
+        for map_name in set(snapshot['mapname']):
+            self.map_id(map_name)
+        new_columns = dict(snapshot, map=map(self.map_ids.__getitem__, snapshot['mapname']))
+
+        changed = bytes(len(order))
+        for field in TRACKED_FIELDS:
+            old_column = map(self.columns[field].__getitem__, order)
+            changed = bytes(map(operator.or_, changed, map(operator.ne, old_column, new_columns[field])))
+        return order, changed
+
+    def map_name(self, row):
+        """
+        Return the map name of row.
+        """
+        return self.map_names[self.columns['map'][row]]
+
+    def increment(self, row, epochs):
+        """
+        Increment the activity counters of row.  Week, day, and hour counters
+        are tagged with the epoch they count, and restart from 0 when
+        incremented in a later epoch, so rollover requires no sweep.
+        """
+        for field in WINDOW_FIELDS:
+            if self.columns[field + '_epoch'][row] != epochs[field]:
+                self.columns[field + '_epoch'][row] = epochs[field]
+                self.columns[field][row] = 0
+            self.columns[field][row] += 1
+        self.columns['consecutive'][row] += 1
+        self.columns['now'][row] = 1
+
+    def window(self, row, field, epochs):
+        """
+        Return the week, day, or hour counter of row, 0 if counted in an earlier epoch.
+        """
+        if self.columns[field + '_epoch'][row] != epochs[field]:
+            return 0
+        return self.columns[field][row]
@@ -6,309 +6,409 @@ hour, consecutive, and current (now) granularity every 'poll_interval'.
 v1.0.0 Koko - 20/01/19
 """
 import os
+import sys
 import logging
 import time
 import datetime
-import pyodbc
+import itertools
+import collections
+import functools
+import threading
 import prometheus_client
+import prometheus_client.core
+import charinfo_store
+
+# Modules shared by the monitors
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'm_common'))
+import activity_log  # noqa: E402
+import aegis_db  # noqa: E402
+import memory_accounting  # noqa: E402
+import poll_scheduler  # noqa: E402
 
 if bool(os.getenv('DEBUG')):
     logging.basicConfig(format='%(asctime)s %(message)s', level=logging.DEBUG)
 else:
     logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
 
+# Gauge names, documentation, and labels
+GAUGES = {
+    'active': {
+        'map': ('character_population', '# of active characters on map', ['map_name']),
+        'character': ('character_active', 'Whether the character is active', ['character', 'email'])
+        },
+    'info': {
+        'base_level': ('character_base_level', 'Character base level', ['character']),
+        'job_level': ('character_job_level', 'Character job level', ['character']),
+        'stat_points': ('character_stat_points', 'Character unallocated stat points', ['character']),
+        'skill_points': ('character_skill_points', 'Character unallocated skill points', ['character']),
+        'money': ('character_money', 'Character money', ['character', 'email'])
+        }
+    }
+
+# Job names, keyed by job id
+JOBS = {
+    0: 'Novice',
+    1: 'Swordman',
+    2: 'Magician',
+    3: 'Archer',
+    4: 'Acolyte',
+    5: 'Merchant',
+    6: 'Thief',
+    7: 'Knight',
+    8: 'Priest',
+    9: 'Wizard',
+    10: 'Blacksmith',
+    11: 'Hunter',
+    12: 'Assassin',
+    13: 'Knight',  # Peco
+    14: 'Crusader',
+    15: 'Monk',
+    16: 'Sage',
+    17: 'Rogue',
+    18: 'Alchemist',
+    19: 'Bard',
+    20: 'Dancer',
+    21: 'Crusader',  # Peco
+    22: 'Wedding',
+    23: 'Super Novice',
+    24: 'Gunslinger',
+    25: 'Ninja',
+    4001: 'Novice High',
+    4002: 'Swordman High',
+    4003: 'Magician High',
+    4004: 'Archer High',
+    4005: 'Acolyte High',
+    4006: 'Merchant High',
+    4007: 'Thief High',
+    4008: 'Lord Knight',
+    4009: 'High Priest',
+    4010: 'High Wizard',
+    4011: 'Whitesmith',
+    4012: 'Sniper',
+    4013: 'Assassin Cross',
+    4014: 'Lord Knight',  # Peco
+    4015: 'Paladin',
+    4016: 'Champion',
+    4017: 'Professor',
+    4018: 'Stalker',
+    4019: 'Creator',
+    4020: 'Clown',
+    4021: 'Gypsy',
+    4022: 'Paladin',  # Peco
+    4023: 'Baby Novice',
+    4024: 'Baby Swordman',
+    4025: 'Baby Magician',
+    4026: 'Baby Archer',
+    4027: 'Baby Acolyte',
+    4028: 'Baby Merchant',
+    4029: 'Baby Thief',
+    4030: 'Baby Knight',
+    4031: 'Baby Priest',
+    4032: 'Baby Wizard',
+    4033: 'Baby Blacksmith',
+    4034: 'Baby Hunter',
+    4035: 'Baby Assassin',
+    4036: 'Baby Knight',  # Peco
+    4037: 'Baby Crusader',
+    4038: 'Baby Monk',
+    4039: 'Baby Sage',
+    4040: 'Baby Rogue',
+    4041: 'Baby Alchemist',
+    4042: 'Baby Bard',
+    4043: 'Baby Dancer',
+    4044: 'Baby Crusader',  # Peco
+    4045: 'Baby Super Novice',
+    4046: 'Taekwon',
+    4047: 'Star Gladiator',
+    4048: 'Star Gladiator',  # Union
+    4049: 'Soul Linker'
+    }
+
 def job_lookup(job_id):
     """
     Translates job_id into job_string.
     """
-    job_dict = {
-        '0': 'Novice',
-        '1': 'Swordman',
-        '2': 'Magician',
-        '3': 'Archer',
-        '4': 'Acolyte',
-        '5': 'Merchant',
-        '6': 'Thief',
-        '7': 'Knight',
-        '8': 'Priest',
-        '9': 'Wizard',
-        '10': 'Blacksmith',
-        '11': 'Hunter',
-        '12': 'Assassin',
-        '13': 'Knight',  # Peco
-        '14': 'Crusader',
-        '15': 'Monk',
-        '16': 'Sage',
-        '17': 'Rogue',
-        '18': 'Alchemist',
-        '19': 'Bard',
-        '20': 'Dancer',
-        '21': 'Crusader',  # Peco
-        '22': 'Wedding',
-        '23': 'Super Novice',
-        '24': 'Gunslinger',
-        '25': 'Ninja',
-        '4001': 'Novice High',
-        '4002': 'Swordman High',
-        '4003': 'Magician High',
-        '4004': 'Archer High',
-        '4005': 'Acolyte High',
-        '4006': 'Merchant High',
-        '4007': 'Thief High',
-        '4008': 'Lord Knight',
-        '4009': 'High Priest',
-        '4010': 'High Wizard',
-        '4011': 'Whitesmith',
-        '4012': 'Sniper',
-        '4013': 'Assassin Cross',
-        '4014': 'Lord Knight',  # Peco
-        '4015': 'Paladin',
-        '4016': 'Champion',
-        '4017': 'Professor',
-        '4018': 'Stalker',
-        '4019': 'Creator',
-        '4020': 'Clown',
-        '4021': 'Gypsy',
-        '4022': 'Paladin',  # Peco
-        '4023': 'Baby Novice',
-        '4024': 'Baby Swordman',
-        '4025': 'Baby Magician',
-        '4026': 'Baby Archer',
-        '4027': 'Baby Acolyte',
-        '4028': 'Baby Merchant',
-        '4029': 'Baby Thief',
-        '4030': 'Baby Knight',
-        '4031': 'Baby Priest',
-        '4032': 'Baby Wizard',
-        '4033': 'Baby Blacksmith',
-        '4034': 'Baby Hunter',
-        '4035': 'Baby Assassin',
-        '4036': 'Baby Knight',  # Peco
-        '4037': 'Baby Crusader',
-        '4038': 'Baby Monk',
-        '4039': 'Baby Sage',
-        '4040': 'Baby Rogue',
-        '4041': 'Baby Alchemist',
-        '4042': 'Baby Bard',
-        '4043': 'Baby Dancer',
-        '4044': 'Baby Crusader',  # Peco
-        '4045': 'Baby Super Novice',
-        '4046': 'Taekwon',
-        '4047': 'Star Gladiator',
-        '4048': 'Star Gladiator',  # Union
-        '4049': 'Soul Linker'
-        }
-    job_str = job_dict[str(job_id)]
-
-    return job_str
+    return JOBS[job_id]
 
-def gen_charinfo_db(server, username, password, database):
+def gen_charinfo_db(connection):
     """
-    Return character positions, id, and info from db charinfo table.
+    Return character positions, id, and info from db charinfo table as a
+    columnar snapshot.
     """
-    # Create a new connection to database
-    logging.debug('Opening connection to %s', server)
-    connection = pyodbc.connect(
-        'DRIVER={driver};SERVER={server};DATABASE={database};UID={username};PWD={password}'.format(
-            driver='{ODBC Driver 17 for SQL Server}',
-            server=server,
-            database=database,
-            username=username,
-            password=password
-            )
-        )
-
     # Perform DB query
-    cursor = connection.cursor()
-    cursor.execute('rocp_admin_charinfo_db')
+    cursor = connection.execute('rocp_admin_charinfo_db')
     results = cursor.fetchall()
 
-    # Close connection
-    logging.debug('Closing connection to %s', server)
-    connection.close()
-
     # Build charinfo_db
-    charinfo_db = {}
-    for result in results:
-        charinfo_db[result[0]] = {
-            'position': {
-                'mapname': result[1],
-                'xPos': result[2],
-                'yPos': result[3]
-                },
-            'id': {
-                'GID': result[4],
-                'AID': result[5],
-                },
-            'info': {
-                'job': result[6],
-                'base_level': result[7],
-                'job_level': result[8],
-                'stat_points': result[9],
-                'skill_points': result[10],
-                'exp': result[11],
-                'jobexp': result[12],
-                'money': result[13]
-                },
-            'email': result[14]
-            }
+    charinfo_db = charinfo_store.gen_snapshot(results)
 
     return charinfo_db
 
-def initialize_active(charinfo_db, gauges):
+def gen_charinfo_hashes(connection):
+    """
+    Return checksums of tracked charinfo columns, keyed by character name.
+    """
+    cursor = connection.execute('rocp_admin_charinfo_hash_db')
+    charinfo_hashes = dict(cursor.fetchall())
+
+    return charinfo_hashes
+
+def gen_charinfo_delta_db(connection, charinfo_hashes):
     """
-    Initialize charinfo_active and mapinfo_active dictionaries.
+    Return a columnar snapshot of only the characters whose checksum differs
+    from charinfo_hashes, along with the latest checksums.  Checksums are
+    fetched before rows, so a character changing in between is re-fetched
+    on the next poll rather than missed.
     """
-    charinfo_active = {}
+    charinfo_hashes_db = gen_charinfo_hashes(connection=connection)
+    characters_changed = [
+        character for character, row_hash in charinfo_hashes_db.items()
+        if charinfo_hashes.get(character) != row_hash
+        ]
+    logging.debug('%s characters changed checksum', len(characters_changed))
+
+    # Fetch full rows for changed characters, passed as a table-valued parameter
+    results = []
+    if characters_changed:
+        cursor = connection.execute(
+            'EXEC rocp_admin_charinfo_delta_db @charnames = ?',
+            [[(character,) for character in characters_changed]]
+            )
+        results = cursor.fetchall()
+
+    charinfo_db = charinfo_store.gen_snapshot(results)
+    charinfo_db['deleted'] = charinfo_hashes.keys() - charinfo_hashes_db.keys()
+
+    return charinfo_db, charinfo_hashes_db
+
+def gen_charinfo_signatures(connection, delta_mode):
+    """
+    Return a signature of the tracked charinfo columns, keyed by character
+    name, from checksums in delta mode or full rows otherwise.
+    """
+    if delta_mode:
+        return gen_charinfo_hashes(connection=connection)
+    charinfo_db = gen_charinfo_db(connection=connection)
+    fields = ('mapname',) + charinfo_store.TRACKED_FIELDS[1:]
+    return dict(zip(charinfo_db['name'], zip(*(charinfo_db[field] for field in fields))))
+
+def detect_sync_phase(pool, histograms, poll_interval, delta_mode, sync_probes, query_timeout=0):
+    """
+    Return the phase, in seconds offset from poll_interval wall-clock ticks,
+    just after the zone server's database sync, or None if no sync was seen.
+    Charinfo is probed 'sync_probes' times over one poll_interval, and the
+    sync is taken to complete by the probe ending the largest burst of
+    changed characters.  Each probe is bounded by query_timeout.
+    """
+    probe_interval = poll_interval / sync_probes
+    with pool.acquire(histograms, query_timeout) as connection:
+        signatures = gen_charinfo_signatures(connection=connection, delta_mode=delta_mode)
+    time_start = time.time()
+
+    probes = []
+    for probe in range(1, sync_probes + 1):
+        time.sleep(max(time_start + probe * probe_interval - time.time(), 0))
+        with pool.acquire(histograms, query_timeout) as connection:
+            signatures_probe = gen_charinfo_signatures(connection=connection, delta_mode=delta_mode)
+        changed = sum(
+            1 for character, signature in signatures_probe.items()
+            if signatures.get(character) != signature
+            )
+        logging.debug('Sync probe %s of %s, %s characters changed', probe, sync_probes, changed)
+        probes.append((changed, time.time()))
+        signatures = signatures_probe
+
+    # Extend the largest burst over following probes still seeing at least half as many changes
+    burst = max(range(len(probes)), key=lambda probe: probes[probe][0])
+    if probes[burst][0] == 0:
+        return None
+    while burst + 1 < len(probes) and probes[burst + 1][0] * 2 >= probes[burst][0]:
+        burst += 1
+    return probes[burst][1] % poll_interval
+
+def update_info_gauges(charinfo_active, character, row, gauges):
+    """
+    Update character info gauges from charinfo_active row.
+    """
+    columns = charinfo_active.columns
+    gauges['info']['base_level'].labels(
+        character=character
+        ).set(columns['base_level'][row])
+    gauges['info']['job_level'].labels(
+        character=character
+        ).set(columns['job_level'][row])
+    gauges['info']['stat_points'].labels(
+        character=character
+        ).set(columns['stat_points'][row])
+    gauges['info']['skill_points'].labels(
+        character=character
+        ).set(columns['skill_points'][row])
+    gauges['info']['money'].labels(
+        character=character,
+        email=charinfo_active.emails[row]
+        ).set(columns['money'][row])
+
+def format_activity(charinfo_active, epochs, row):
+    """
+    Return the activity log line of charinfo_active row.
+    """
+    columns = charinfo_active.columns
+    return (
+        '{character:25} {job:15} {location:25} blv:{base_level:3} jlv:{job_level:3} '
+        'bpts:{stat_points:3} jpts:{skill_points:3} c:{consecutive:3} '
+        'h:{hour:3} d:{day:3} w:{week:3}'.format(
+            character=charinfo_active.names[row],
+            job=job_lookup(columns['job'][row]),
+            location='{} ({},{})'.format(charinfo_active.map_name(row), columns['xPos'][row], columns['yPos'][row]),
+            base_level=columns['base_level'][row],
+            job_level=columns['job_level'][row],
+            stat_points=columns['stat_points'][row],
+            skill_points=columns['skill_points'][row],
+            consecutive=columns['consecutive'][row],
+            hour=charinfo_active.window(row, 'hour', epochs),
+            day=charinfo_active.window(row, 'day', epochs),
+            week=charinfo_active.window(row, 'week', epochs)
+            )
+        )
+
+def initialize_active(charinfo_db, gauges, verbose=True):
+    """
+    Initialize charinfo_active store and mapinfo_active dictionary.
+    """
+    charinfo_active = charinfo_store.CharinfoStore()
     mapinfo_active = {}
-    for character in charinfo_db:
-        logging.info('Initializing character %s', character)
-        charinfo_active[character] = {
-            'position': charinfo_db[character]['position'],
-            'info': charinfo_db[character]['info'],
-            'id': charinfo_db[character]['id'],
-            'active': {
-                'week': 0,
-                'day': 0,
-                'hour': 0,
-                'consecutive': 0,
-                'now': 0
-                },
-            'email': charinfo_db[character]['email']
-            }
+    for index, character in enumerate(charinfo_db['name']):
+        if verbose:
+            logging.info('Initializing character %s', character)
+        row = charinfo_active.add(character, charinfo_db, index)
 
         # Update character info gauges
-        gauges['info']['base_level'].labels(
-            character=character
-            ).set(charinfo_active[character]['info']['base_level'])
-        gauges['info']['job_level'].labels(
-            character=character
-            ).set(charinfo_active[character]['info']['job_level'])
-        gauges['info']['stat_points'].labels(
-            character=character
-            ).set(charinfo_active[character]['info']['stat_points'])
-        gauges['info']['skill_points'].labels(
-            character=character
-            ).set(charinfo_active[character]['info']['skill_points'])
-        gauges['info']['money'].labels(
-            character=character,
-            email=charinfo_active[character]['email']
-            ).set(charinfo_active[character]['info']['money'])
+        if gauges is not None:
+            update_info_gauges(charinfo_active, character, row, gauges)
+    logging.info('Initialized %s characters', len(charinfo_active))
 
     return charinfo_active, mapinfo_active
 
-def update_active(charinfo_active, mapinfo_active, charinfo_db, gauges):
+def restore_active(state_file, gauges):
     """
-    Update charinfo_active and mapinfo_active dictionaries to latest character state.
+    Return charinfo_active store and mapinfo_active dictionary restored from
+    state_file, or None if no usable state is stored.
     """
+    charinfo_active = aegis_db.load_state(
+        state_file,
+        charinfo_store.STATE_VERSION,
+        charinfo_store.CharinfoStore.from_state
+        )
+    if charinfo_active is None:
+        return None
+    logging.info('Restored %s characters from %s', len(charinfo_active), state_file)
+
+    # Update character gauges
+    if gauges is not None:
+        for character, row in charinfo_active.rows.items():
+            gauges['active']['character'].labels(
+                character=character,
+                email=charinfo_active.emails[row]
+                ).set(charinfo_active.columns['now'][row])
+            update_info_gauges(charinfo_active, character, row, gauges)
+
+    return charinfo_active, {}
+
+def update_active(charinfo_active, mapinfo_active, charinfo_db, epochs, activity=None):
+    """
+    Update charinfo_active store and mapinfo_active dictionary to latest character state.
+    Changes are detected for all characters in one pass per field, then
+    only changed or previously active characters are visited.  Character
+    activity is logged through 'activity', ranked by consecutive polls active.
+    Return both, and the rows updated and (character, email) of characters
+    removed, for update_gauges.
+    """
+    if activity is None:
+        activity = activity_log.ActivityLog()
+    columns = charinfo_active.columns
     for map_name in mapinfo_active:
         mapinfo_active[map_name] = 0
 
-    # Create charinfo_active keys for new characters
-    characters_created = charinfo_db.keys() - charinfo_active.keys()
+    # Add rows for new characters
+    characters_db = dict(zip(charinfo_db['name'], range(len(charinfo_db['name']))))
+    characters_created = characters_db.keys() - charinfo_active.rows.keys()
     for character in characters_created:
-        logging.info('Character %s is new, adding to charinfo_active', character)
-        charinfo_active[character] = {
-            'position': charinfo_db[character]['position'],
-            'info': charinfo_db[character]['info'],
-            'id': charinfo_db[character]['id'],
-            'active': {
-                'week': 0,
-                'day': 0,
-                'hour': 0,
-                'consecutive': 0,
-                'now': 0
-                },
-            'email': charinfo_db[character]['email']
-            }
-
-    # Remove charinfo_active keys for deleted characters
-    characters_removed = charinfo_active.keys() - charinfo_db.keys()
+        if activity.verbose:
+            logging.info('Character %s is new, adding to charinfo_active', character)
+        charinfo_active.add(character, charinfo_db, characters_db[character])
+
+    # Remove rows of deleted characters, delta snapshots list them explicitly
+    if 'deleted' in charinfo_db:
+        characters_removed = charinfo_db['deleted'] & charinfo_active.rows.keys()
+    else:
+        characters_removed = charinfo_active.rows.keys() - characters_db.keys()
+    removed = []
     for character in characters_removed:
-        logging.info('Character %s is deleted, removing from charinfo_active', character)
+        if activity.verbose:
+            logging.info('Character %s is deleted, removing from charinfo_active', character)
+        removed.append((character, charinfo_active.emails[charinfo_active.rows[character]]))
+        charinfo_active.remove(character)
+
+    # Character is active if position|info differs from last recorded position|info
+    order, changed = charinfo_active.detect_changes(charinfo_db)
+    rows_changed = [order[index] for index in itertools.compress(range(len(order)), changed)]
+    for index in itertools.compress(range(len(order)), changed):
+        charinfo_active.set_tracked(order[index], charinfo_db, index)
+
+    # Character was previously active
+    rows_stopped = set(itertools.compress(range(len(columns['now'])), columns['now']))
+    rows_stopped.difference_update(rows_changed)
+
+    # Apply counter increments and resets
+    for row in rows_changed:
+        charinfo_active.increment(row, epochs)
+    for row in rows_stopped:
+        columns['consecutive'][row] = 0
+        columns['now'][row] = 0
+
+    # Log activity of updated characters
+    rows_updated = list(itertools.chain(rows_changed, rows_stopped))
+    for row in rows_updated:
+        activity.add(columns['consecutive'][row], row)
+
+    # Update mapinfo_active dictionary
+    map_counts = collections.Counter(map(columns['map'].__getitem__, rows_changed))
+    for map_id, count in map_counts.items():
+        mapinfo_active[charinfo_active.map_names[map_id]] = count
+
+    activity.flush(
+        functools.partial(format_activity, charinfo_active, epochs),
+        '%s characters active, %s stopped, %s new, %s deleted',
+        len(rows_changed),
+        len(rows_stopped),
+        len(characters_created),
+        len(characters_removed)
+        )
+
+    return charinfo_active, mapinfo_active, (rows_updated, removed)
+
+
+def update_gauges(charinfo_active, mapinfo_active, updated, gauges):
+    """
+    Update character and map gauges of the rows updated and characters
+    removed by update_active.
+    """
+    columns = charinfo_active.columns
+    rows_updated, removed = updated
+    for character, email in removed:
         gauges['active']['character'].labels(
             character=character,
-            email=charinfo_active[character]['email'],
+            email=email
             ).set(0)
-        del charinfo_active[character]
-
-    # Update charinfo_active state and character gauges
-    for character in charinfo_db:
-        # Character is active if position|info differs from last recorded position|info
-        if (
-                charinfo_db[character]['position'] != charinfo_active[character]['position'] or
-                charinfo_db[character]['info'] != charinfo_active[character]['info']
-            ):
-            update_character, update_map = True, True
-            charinfo_active[character]['position'] = charinfo_db[character]['position']
-            charinfo_active[character]['info'] = charinfo_db[character]['info']
-            charinfo_active[character]['active']['week'] += 1
-            charinfo_active[character]['active']['day'] += 1
-            charinfo_active[character]['active']['hour'] += 1
-            charinfo_active[character]['active']['consecutive'] += 1
-            charinfo_active[character]['active']['now'] = 1
-
-        # Character was previously active
-        elif charinfo_active[character]['active']['now'] == 1:
-            update_character, update_map = True, False
-            charinfo_active[character]['active']['consecutive'] = 0
-            charinfo_active[character]['active']['now'] = 0
-        else:
-            update_character, update_map = False, False
 
-        if update_character is True:
-            # Update character active gauge
-            gauges['active']['character'].labels(
-                character=character,
-                email=charinfo_active[character]['email']
-                ).set(charinfo_active[character]['active']['now'])
-
-            # Update character info gauges
-            gauges['info']['base_level'].labels(
-                character=character
-                ).set(charinfo_active[character]['info']['base_level'])
-            gauges['info']['job_level'].labels(
-                character=character
-                ).set(charinfo_active[character]['info']['job_level'])
-            gauges['info']['stat_points'].labels(
-                character=character
-                ).set(charinfo_active[character]['info']['stat_points'])
-            gauges['info']['skill_points'].labels(
-                character=character
-                ).set(charinfo_active[character]['info']['skill_points'])
-            gauges['info']['money'].labels(
-                character=character,
-                email=charinfo_active[character]['email']
-                ).set(charinfo_active[character]['info']['money'])
-
-            logging.info(
-                '{character:25} {job:15} {location:25} blv:{base_level:3} jlv:{job_level:3} '
-                'bpts:{stat_points:3} jpts:{skill_points:3} c:{consecutive:3} '
-                'h:{hour:3} d:{day:3} w:{week:3}'.format(
-                    character=character,
-                    job=job_lookup(charinfo_active[character]['info']['job']),
-                    location='{mapname} ({xPos},{yPos})'.format(
-                        mapname=charinfo_active[character]['position']['mapname'],
-                        xPos=charinfo_active[character]['position']['xPos'],
-                        yPos=charinfo_active[character]['position']['yPos']
-                        ),
-                    base_level=charinfo_active[character]['info']['base_level'],
-                    job_level=charinfo_active[character]['info']['job_level'],
-                    stat_points=charinfo_active[character]['info']['stat_points'],
-                    skill_points=charinfo_active[character]['info']['skill_points'],
-                    consecutive=charinfo_active[character]['active']['consecutive'],
-                    hour=charinfo_active[character]['active']['hour'],
-                    day=charinfo_active[character]['active']['day'],
-                    week=charinfo_active[character]['active']['week']
-                    )
-                )
-
-        if update_map is True:
-            # Update mapinfo_active dictionary
-            try:
-                mapinfo_active[charinfo_active[character]['position']['mapname']] += 1
-            except KeyError:
-                mapinfo_active[charinfo_active[character]['position']['mapname']] = 1
+    # Update character active and info gauges
+    for row in rows_updated:
+        character = charinfo_active.names[row]
+        gauges['active']['character'].labels(
+            character=character,
+            email=charinfo_active.emails[row]
+            ).set(columns['now'][row])
+        update_info_gauges(charinfo_active, character, row, gauges)
 
     # Update map active gauge
     for map_name in mapinfo_active:
@@ -316,156 +416,421 @@ def update_active(charinfo_active, mapinfo_active, charinfo_db, gauges):
             map_name=map_name
             ).set(mapinfo_active[map_name])
 
-    return charinfo_active, mapinfo_active
-
 
 def reset_active(charinfo_active, last_reset):
     """
-    Reset charinfo_active active counters.
+    Advance charinfo_active active counters to the current week, day, and hour.
+    Counters are tagged with the epoch they count and restart lazily, so
+    rollover costs the same regardless of the number of characters.
     """
-    # Set current time
-    time_now = datetime.datetime.now()
+    epochs = poll_scheduler.window_epochs(datetime.datetime.now())
+    for window in ['week', 'day', 'hour']:
+        if epochs[window] != last_reset[window]:
+            logging.info('Rolling over %s counters', window)
 
-    # Reset week, day, & hour if week rollover
-    if time_now - datetime.timedelta(weeks=1) > last_reset['week']:
-        logging.info('Resetting week, day, and hour counters')
-        last_reset['week'] = time_now
-        last_reset['day'] = time_now
-        last_reset['hour'] = time_now
+    return charinfo_active, epochs
 
-        for character in charinfo_active:
-            charinfo_active[character]['active']['week'] = 0
-            charinfo_active[character]['active']['day'] = 0
-            charinfo_active[character]['active']['hour'] = 0
 
-    # Reset day & hour if day rollover
-    elif time_now - datetime.timedelta(days=1) > last_reset['day']:
-        logging.info('Resetting day and hour counters')
-        last_reset['day'] = time_now
-        last_reset['hour'] = time_now
+class CharinfoCollector:
+    """
+    Prometheus collector rendering character and map gauges from
+    charinfo_active and mapinfo_active at scrape time, in place of per-poll
+    gauge updates.
+    """
+    def __init__(self, charinfo_active, mapinfo_active, lock):
+        self.charinfo_active = charinfo_active
+        self.mapinfo_active = mapinfo_active
+        self.lock = lock
+
+    def collect(self):
+        """
+        Yield character and map gauge families in one pass over charinfo_active.
+        """
+        families = {
+            group: {
+                key: prometheus_client.core.GaugeMetricFamily(
+                    name=name,
+                    documentation=documentation,
+                    labels=labelnames
+                    )
+                for key, (name, documentation, labelnames) in metrics.items()
+                }
+            for group, metrics in GAUGES.items()
+            }
+        with self.lock:
+            columns = self.charinfo_active.columns
+            for character, row in self.charinfo_active.rows.items():
+                email = str(self.charinfo_active.emails[row])
+                families['active']['character'].add_metric([character, email], columns['now'][row])
+                for field in ['base_level', 'job_level', 'stat_points', 'skill_points']:
+                    families['info'][field].add_metric([character], columns[field][row])
+                families['info']['money'].add_metric([character, email], columns['money'][row])
+
+            for map_name, population in self.mapinfo_active.items():
+                families['active']['map'].add_metric([map_name], population)
+
+        for metrics in families.values():
+            yield from metrics.values()
+
+
+def setup_active(pool, poll_interval, poll_phase, sync_probes, delta_mode, collector_mode, state_file,
+                 state_interval, log_verbosity, log_top_n, log_anomaly_threshold, pipeline,
+                 query_timeout, breaker_failures, breaker_reset,
+                 registry=prometheus_client.REGISTRY):
+    """
+    Define metrics and initialize charinfo_active, restoring it from
+    state_file if stored.  Return the monitor state polled by poll_active,
+    its metrics registered in registry.
+    """
+    # Define gauges, collector mode renders them from charinfo_active at scrape time instead
+    if collector_mode:
+        gauges = None
+    else:
+        gauges = {
+            group: {
+                key: prometheus_client.Gauge(
+                    name=name,
+                    documentation=documentation,
+                    labelnames=labelnames,
+                    registry=registry
+                    )
+                for key, (name, documentation, labelnames) in metrics.items()
+                }
+            for group, metrics in GAUGES.items()
+            }
 
-        for character in charinfo_active:
-            charinfo_active[character]['active']['day'] = 0
-            charinfo_active[character]['active']['hour'] = 0
+    # Define database histograms
+    histograms = {
+        'connect': prometheus_client.Histogram(
+            name='charinfo_db_connect_seconds',
+            documentation='Time spent opening the database connection',
+            registry=registry
+            ),
+        'query': prometheus_client.Histogram(
+            name='charinfo_db_query_seconds',
+            documentation='Time spent executing rocp_admin_charinfo_db',
+            registry=registry
+            )
+        }
+
+    # Define activity log, anomalies are characters active for 'log_anomaly_threshold' consecutive polls
+    activity = activity_log.ActivityLog(
+        verbosity=log_verbosity,
+        top_n=log_top_n,
+        anomaly_threshold=log_anomaly_threshold
+        )
+
+    # Learn the zone server sync phase, polling just after each sync rather than at poll_phase
+    sync_gauge = prometheus_client.Gauge(
+        name='charinfo_sync_phase_seconds',
+        documentation='Poll phase, in seconds offset from poll_interval wall-clock ticks',
+        registry=registry
+        )
+    if sync_probes:
+        logging.info('Detecting sync phase with %s probes over %s seconds', sync_probes, poll_interval)
+        sync_phase = detect_sync_phase(pool, histograms, poll_interval, delta_mode, sync_probes, query_timeout)
+        if sync_phase is None:
+            logging.warning('No sync detected, polling at phase %s seconds', poll_phase)
+        else:
+            logging.info('Detected sync phase %.0f seconds', sync_phase)
+            poll_phase = sync_phase
+    sync_gauge.set(poll_phase)
+
+    # Set current week, day, and hour counter epochs
+    last_reset = poll_scheduler.window_epochs(datetime.datetime.now())
+
+    # Restore charinfo_active and mapinfo_active dictionaries from the last saved state
+    restored = restore_active(state_file=state_file, gauges=gauges) if state_file else None
+    if restored is not None:
+        charinfo_active, mapinfo_active = restored
 
-    # Reset hour if hour rollover
-    elif time_now - datetime.timedelta(hours=1) > last_reset['hour']:
-        logging.info('Resetting hour counter')
-        last_reset['hour'] = time_now
+        # Refetch all restored characters on the first delta poll, catching changes while stopped
+        charinfo_hashes = dict.fromkeys(charinfo_active.rows) if delta_mode else {}
 
-        for character in charinfo_active:
-            charinfo_active[character]['active']['hour'] = 0
+    # Initialize charinfo_active and mapinfo_active dictionaries
+    else:
+        with pool.acquire(histograms, query_timeout) as connection:
+            charinfo_hashes = gen_charinfo_hashes(connection=connection) if delta_mode else {}
+            charinfo_db = gen_charinfo_db(connection=connection)
+        charinfo_active, mapinfo_active = initialize_active(
+            charinfo_db=charinfo_db,
+            gauges=gauges,
+            verbose=activity.verbose
+            )
+    charinfo_lock = threading.Lock()
+    if collector_mode:
+        registry.register(
+            CharinfoCollector(charinfo_active, mapinfo_active, charinfo_lock)
+            )
 
-    return charinfo_active, last_reset
+    # Define circuit breaker, serving the last snapshot while the database is failing
+    breaker = aegis_db.CircuitBreaker(
+        prefix='charinfo',
+        failures=breaker_failures,
+        reset_timeout=breaker_reset,
+        registry=registry
+        )
 
+    # Define memory accounting of monitor state and gauge children, served at /memory once
+    # the initial fetch succeeded so a failed setup leaves no account behind
+    memory = memory_accounting.MemoryAccounting(
+        prefix='charinfo',
+        metrics={
+            name: gauges[group][key]
+            for group, metrics in GAUGES.items()
+            for key, (name, _, _) in metrics.items()
+            } if gauges is not None else {},
+        registry=registry
+        )
+
+    # Schedule polls on wall-clock ticks, restored state is compared on the first tick,
+    # initialized state no sooner than one interval later
+    scheduler = poll_scheduler.PollScheduler(
+        prefix='charinfo',
+        interval=poll_interval,
+        phase=poll_phase,
+        not_before=time.time() + (0 if restored is not None else poll_interval),
+        registry=registry
+        )
 
-def monitor_active(db_hostname, db_username, db_password, db_database, poll_interval):
+    return {
+        'pool': pool,
+        'poll_interval': poll_interval,
+        'scheduler': scheduler,
+        'pipeline': pipeline,
+        'query_timeout': query_timeout,
+        'breaker': breaker,
+        'delta_mode': delta_mode,
+        'state_file': state_file,
+        'state_interval': state_interval,
+        'gauges': gauges,
+        'histograms': histograms,
+        'activity': activity,
+        'memory': memory,
+        'charinfo_active': charinfo_active,
+        'mapinfo_active': mapinfo_active,
+        'charinfo_hashes': charinfo_hashes,
+        'last_reset': last_reset,
+        'last_save': time.time(),
+        'lock': charinfo_lock
+        }
+
+
+def fetch_active(monitor):
+    """
+    Return charinfo_db fetched from the database, for process_active, or
+    None if the fetch failed or the circuit breaker is open.
+    """
+    scheduler = monitor['scheduler']
+    breaker = monitor['breaker']
+    if not breaker.allow():
+        return None
+
+    # Generate new charinfo from database, each query bounded by query_timeout
+    try:
+        with scheduler.time_phase('fetch'), monitor['pool'].acquire(
+                monitor['histograms'], monitor['query_timeout']) as connection:
+            if monitor['delta_mode']:
+                charinfo_db, monitor['charinfo_hashes'] = gen_charinfo_delta_db(
+                    connection=connection,
+                    charinfo_hashes=monitor['charinfo_hashes']
+                    )
+            else:
+                charinfo_db = gen_charinfo_db(connection=connection)
+    except aegis_db.QUERY_ERRORS as error:
+        breaker.failure(error)
+        return None
+    breaker.success()
+
+    return charinfo_db
+
+
+def process_active(monitor, charinfo_db):
     """
-    Monitor active characters with reference to changing map positions.
+    Update monitor state and metrics from a fetched charinfo_db, timing each
+    phase.  Metrics keep serving the last snapshot if none was fetched.
     """
-    # Define gauges
-    gauges = {
-        'active': {
-            'map': prometheus_client.Gauge(
-                name='character_population',
-                documentation='# of active characters on map',
-                labelnames=['map_name']
-                ),
-            'character': prometheus_client.Gauge(
-                name='character_active',
-                documentation='Whether the character is active',
-                labelnames=['character', 'email']
+    scheduler = monitor['scheduler']
+    if charinfo_db is None:
+        return
+
+    with monitor['lock']:
+        # Advance counters to the current week, day, and hour
+        with scheduler.time_phase('reset'):
+            monitor['charinfo_active'], monitor['last_reset'] = reset_active(
+                charinfo_active=monitor['charinfo_active'],
+                last_reset=monitor['last_reset']
                 )
-            },
-        'info': {
-            'base_level': prometheus_client.Gauge(
-                name='character_base_level',
-                documentation='Character base level',
-                labelnames=['character']
-                ),
-            'job_level': prometheus_client.Gauge(
-                name='character_job_level',
-                documentation='Character job level',
-                labelnames=['character']
-                ),
-            'stat_points': prometheus_client.Gauge(
-                name='character_stat_points',
-                documentation='Character unallocated stat points',
-                labelnames=['character']
-                ),
-            'skill_points': prometheus_client.Gauge(
-                name='character_skill_points',
-                documentation='Character unallocated skill points',
-                labelnames=['character']
-                ),
-            'money': prometheus_client.Gauge(
-                name='character_money',
-                documentation='Character money',
-                labelnames=['character', 'email']
+
+        # Update active characters and maps
+        with scheduler.time_phase('update'):
+            monitor['charinfo_active'], monitor['mapinfo_active'], updated = update_active(
+                charinfo_active=monitor['charinfo_active'],
+                mapinfo_active=monitor['mapinfo_active'],
+                charinfo_db=charinfo_db,
+                epochs=monitor['last_reset'],
+                activity=monitor['activity']
                 )
-            }
+
+        # Update gauges, collector mode renders them at scrape time instead
+        if monitor['gauges'] is not None:
+            with scheduler.time_phase('gauges'):
+                update_gauges(
+                    charinfo_active=monitor['charinfo_active'],
+                    mapinfo_active=monitor['mapinfo_active'],
+                    updated=updated,
+                    gauges=monitor['gauges']
+                    )
+
+        # Account memory of monitor state and the fetched rows
+        with scheduler.time_phase('account'):
+            monitor['memory'].account(
+                structures={
+                    'charinfo_active': monitor['charinfo_active'],
+                    'mapinfo_active': monitor['mapinfo_active'],
+                    'charinfo_hashes': monitor['charinfo_hashes'],
+                    'charinfo_db': charinfo_db
+                    },
+                entries={'charinfo_db': len(charinfo_db['name'])}
+                )
+
+        # Persist state every 'state_interval' seconds
+        if monitor['state_file'] and time.time() - monitor['last_save'] >= monitor['state_interval']:
+            with scheduler.time_phase('save'):
+                aegis_db.save_state(
+                    monitor['state_file'],
+                    charinfo_store.STATE_VERSION,
+                    monitor['charinfo_active'].state()
+                    )
+            monitor['last_save'] = time.time()
+
+
+def poll_active(monitor):
+    """
+    Poll the database once, updating monitor state and metrics.
+    """
+    process_active(monitor, fetch_active(monitor))
+
+
+def config_from_env(prefix=''):
+    """
+    Return setup_active arguments from environment variables, optionally prefixed e.g. ACTIVE_.
+    """
+    poll_interval = int(os.getenv(prefix + 'POLL_INTERVAL'))
+    return {
+        'poll_interval': poll_interval,
+        'poll_phase': float(os.getenv(prefix + 'POLL_PHASE', '0')),
+        'sync_probes': int(os.getenv(prefix + 'SYNC_PROBES', '0')),
+        'delta_mode': bool(os.getenv(prefix + 'DELTA_MODE')),
+        'collector_mode': bool(os.getenv(prefix + 'COLLECTOR_MODE')),
+        'state_file': str(os.getenv(prefix + 'STATE_FILE', '')),
+        'state_interval': int(os.getenv(
+            prefix + 'STATE_INTERVAL',
+            str(aegis_db.STATE_INTERVAL_POLLS * poll_interval)
+            )),
+        'log_verbosity': str(os.getenv(prefix + 'LOG_VERBOSITY', 'all')),
+        'log_top_n': int(os.getenv(prefix + 'LOG_TOP_N', '10')),
+        'log_anomaly_threshold': int(os.getenv(prefix + 'LOG_ANOMALY_THRESHOLD', '12')),
+        'pipeline': bool(os.getenv(prefix + 'PIPELINE')),
+        'query_timeout': int(os.getenv(prefix + 'QUERY_TIMEOUT', '0')),
+        'breaker_failures': int(os.getenv(prefix + 'BREAKER_FAILURES', '3')),
+        'breaker_reset': int(os.getenv(prefix + 'BREAKER_RESET', '300'))
         }
 
-    # Set reset rollover timestamps, last monday, midnight, last hour
-    time_now = datetime.datetime.now()
-    last_reset = {
-        'week': time_now - datetime.timedelta(days=time_now.weekday()),
-        'day': time_now.replace(hour=0, minute=0, second=0, microsecond=0),
-        'hour': time_now.replace(minute=0, second=0, microsecond=0)
+
+# Runner plugin entry points, see m_runner
+PLUGIN = {
+    'config': config_from_env,
+    'setup': setup_active,
+    'poll': poll_active,
+    'fetch': fetch_active,
+    'process': process_active,
+    'database': True
+    }
+
+
+def run_active(monitor):
+    """
+    Poll monitor on its scheduler's ticks forever.
+    """
+    # Pipelined mode fetches each poll while the last is processed
+    if monitor['pipeline']:
+        poll_scheduler.run_pipelined(monitor['scheduler'], fetch_active, process_active, monitor)
+    while True:
+        monitor['scheduler'].wait()
+        monitor['scheduler'].profiled(poll_active, monitor)
+        logging.info('Iteration complete, sleeping %.0f seconds', monitor['scheduler'].finish())
+
+
+def monitor_active(db_driver, db_hostname, db_username, db_password, db_database, db_shards,
+                   poll_interval, poll_phase, sync_probes, delta_mode, collector_mode, state_file,
+                   state_interval, log_verbosity, log_top_n, log_anomaly_threshold, pipeline,
+                   query_timeout, breaker_failures, breaker_reset):
+    """
+    Monitor active characters with reference to changing map positions,
+    of each of db_shards concurrently if given.
+    """
+    activity_log.start_queue_logging()
+
+    config = {
+        'poll_interval': poll_interval,
+        'poll_phase': poll_phase,
+        'sync_probes': sync_probes,
+        'delta_mode': delta_mode,
+        'collector_mode': collector_mode,
+        'state_file': state_file,
+        'state_interval': state_interval,
+        'log_verbosity': log_verbosity,
+        'log_top_n': log_top_n,
+        'log_anomaly_threshold': log_anomaly_threshold,
+        'pipeline': pipeline,
+        'query_timeout': query_timeout,
+        'breaker_failures': breaker_failures,
+        'breaker_reset': breaker_reset
         }
 
-    # Initialize charinfo_active and mapinfo_active dictionaries
-    charinfo_db = gen_charinfo_db(
+    # Poll each shard from its own thread, with its own connection pool, state files, and metrics
+    if db_shards:
+        aegis_db.run_shards(
+            setup_active, run_active, db_shards, db_driver, db_username, config, files=['state_file']
+            )
+
+    # Define database connection pool, its connection is opened on first use and kept open
+    pool = aegis_db.ConnectionPool(
+        driver=db_driver,
         server=db_hostname,
         username=db_username,
         password=db_password,
         database=db_database
         )
-    charinfo_active, mapinfo_active = initialize_active(charinfo_db=charinfo_db, gauges=gauges)
-    time.sleep(poll_interval)
-
-    # Begin monitor loop
-    while True:
-        # Generate new charinfo from database
-        charinfo_db = gen_charinfo_db(
-            server=db_hostname,
-            username=db_username,
-            password=db_password,
-            database=db_database
-            )
-
-        # Update active characters and maps
-        charinfo_active, mapinfo_active = update_active(
-            charinfo_active=charinfo_active,
-            mapinfo_active=mapinfo_active,
-            charinfo_db=charinfo_db,
-            gauges=gauges
-            )
-
-        # Prepare for next iteration
-        charinfo_active, last_reset = reset_active(
-            charinfo_active=charinfo_active,
-            last_reset=last_reset
-            )
-        logging.info('Iteration complete, sleeping %s seconds', poll_interval)
-        time.sleep(poll_interval)
+    run_active(setup_active(pool=pool, **config))
 
 
 if __name__ == '__main__':
-    POLL_INTERVAL = int(os.getenv('POLL_INTERVAL'))
     PROMETHEUS_PORT = int(os.getenv('PROMETHEUS_PORT'))
+    DB_DRIVER = str(os.getenv('DB_DRIVER', 'mssql'))
     DB_HOSTNAME = str(os.getenv('DB_HOSTNAME'))
     DB_DATABASE = str(os.getenv('DB_DATABASE'))
     DB_USERNAME = str(os.getenv('DB_USERNAME'))
-    DB_PASSWORD = open('/run/secrets/DB_PASSWORD').read()
+    DB_PASSWORD = open('/run/secrets/DB_PASSWORD').read() if DB_DRIVER == 'mssql' else ''
+    DB_SHARDS = aegis_db.parse_shards(str(os.getenv('DB_SHARDS', '')), DB_PASSWORD)
+
+    PROFILE_POLLS = int(os.getenv('PROFILE_POLLS', '5'))
+    PROFILE_DIR = str(os.getenv('PROFILE_DIR', '/tmp'))
 
+    MEMORY_PORT = int(os.getenv('MEMORY_PORT', '0'))
+    TRACEMALLOC_FRAMES = int(os.getenv('TRACEMALLOC_FRAMES', '0'))
+
+    memory_accounting.start_memory_server(MEMORY_PORT, TRACEMALLOC_FRAMES)
+    poll_scheduler.profile_on_signal(PROFILE_POLLS, PROFILE_DIR)
     prometheus_client.start_http_server(PROMETHEUS_PORT)
 
     monitor_active(
+        db_driver=DB_DRIVER,
         db_hostname=DB_HOSTNAME,
         db_username=DB_USERNAME,
         db_password=DB_PASSWORD,
         db_database=DB_DATABASE,
-        poll_interval=POLL_INTERVAL
+        db_shards=DB_SHARDS,
+        **config_from_env()
         )
-
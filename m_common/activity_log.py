@@ -0,0 +1,79 @@
+"""
+Per-poll activity logging for Aegis monitors.
+Activity lines are collected while a poll is processed, and emitted once
+it completes according to the configured verbosity: every line, the top N
+by score, only anomalies scoring at or above a threshold, or a summary
+alone.  Lines are formatted only when emitted, and written by a background
+thread behind a queue so logging never blocks a poll on Docker's log driver.
+Shared by m_active and m_itemlog.
+"""
+import heapq
+import logging
+import logging.handlers
+import queue
+
+VERBOSITIES = ('all', 'top', 'anomalies', 'summary')
+
+
+def start_queue_logging():
+    """
+    Move the root logger's handlers behind a queue, written by a background
+    listener thread.  Return the listener, or None if already queued.
+    """
+    root = logging.getLogger()
+    if any(isinstance(handler, logging.handlers.QueueHandler) for handler in root.handlers):
+        return None
+
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, *root.handlers, respect_handler_level=True)
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    listener.start()
+    return listener
+
+
+class ActivityLog:
+    """
+    Activity lines of one poll, each an item scored for ranking and
+    formatted only when emitted.
+    """
+    def __init__(self, verbosity='all', top_n=10, anomaly_threshold=0):
+        if verbosity not in VERBOSITIES:
+            raise ValueError('LOG_VERBOSITY must be one of {}'.format(', '.join(VERBOSITIES)))
+        self.verbosity = verbosity
+        self.top_n = top_n
+        self.anomaly_threshold = anomaly_threshold
+        self.items = []
+
+    @property
+    def verbose(self):
+        """
+        Whether per-character bookkeeping lines (new, deleted, evicted) are logged.
+        """
+        return self.verbosity == 'all'
+
+    def add(self, score, item):
+        """
+        Add an activity line for item.
+        """
+        self.items.append((score, item))
+
+    def flush(self, formatter, summary, *args):
+        """
+        Emit the selected activity lines, formatted by formatter(item),
+        followed by the summary line, and start collecting the next poll.
+        """
+        items, self.items = self.items, []
+        if self.verbosity == 'all':
+            selected = items
+        elif self.verbosity == 'top':
+            selected = heapq.nlargest(self.top_n, items, key=lambda scored: scored[0])
+        elif self.verbosity == 'anomalies':
+            selected = [scored for scored in items if scored[0] >= self.anomaly_threshold]
+        else:
+            selected = []
+
+        # Skip formatting lines the root logger would discard
+        if logging.getLogger().isEnabledFor(logging.INFO):
+            for _, item in selected:
+                logging.info('%s', formatter(item))
+        logging.info(summary, *args)
@@ -0,0 +1,602 @@
+"""
+Persistent database connection manager for Aegis MSSQL monitors.
+Keeps a single long-lived pyodbc connection open between polls rather than
+reconnecting (and renegotiating TLS) every 'poll_interval'.
+A SQLite stand-in implementing the same stored procedures allows the
+monitors to be run and benchmarked without an Aegis database.  Monitor
+state is persisted between restarts with save_state and load_state.
+Connections are leased from a ConnectionPool, which monitors run in a
+single process share.  Leases may bound each query with a timeout, and a
+CircuitBreaker stops polling a failing database for a while, the monitor
+serving its last good snapshot meanwhile.  Several Aegis databases (shards,
+e.g. game worlds) may be polled concurrently from one process, each with
+its own connections, state, and metrics registry labelled by shard.
+Shared by m_active and m_itemlog.
+"""
+import contextlib
+import logging
+import os
+import pickle
+import queue
+import re
+import sqlite3
+import struct
+import threading
+import time
+import prometheus_client
+
+# pyodbc needs unixODBC, absent on hosts running only the SQLite stand-in
+try:
+    import pyodbc
+except ImportError:
+    pyodbc = None
+
+# State file header, magic and schema version
+STATE_HEADER = struct.Struct('>4sH')
+STATE_MAGIC = b'ROCP'
+
+# Default polls between state saves, each pickling and fsyncing the whole state under the lock
+STATE_INTERVAL_POLLS = 5
+
+# Seconds before a failed shard is set up or polled again
+SHARD_RESTART_DELAY = 60
+
+# SQLite stand-in tables, charinfo is denormalized with the account email
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS charinfo (
+    CharName TEXT PRIMARY KEY,
+    mapname TEXT,
+    xPos INTEGER,
+    yPos INTEGER,
+    GID INTEGER,
+    AID INTEGER,
+    job INTEGER,
+    clevel INTEGER,
+    joblevel INTEGER,
+    jobpoint INTEGER,
+    sppoint INTEGER,
+    exp INTEGER,
+    jobexp INTEGER,
+    money INTEGER,
+    email TEXT
+    );
+CREATE TABLE IF NOT EXISTS ItemLog (
+    LogID INTEGER PRIMARY KEY,
+    logtime TEXT,
+    srcCharName TEXT,
+    srcCharID INTEGER,
+    srcAccountID INTEGER,
+    Action INTEGER
+    );
+CREATE INDEX IF NOT EXISTS ItemLog_logtime ON ItemLog (logtime);
+"""
+
+# SQLite stand-in table-valued parameter types, keyed by parameter name
+SQLITE_TABLE_TYPES = {
+    'charnames': 'CREATE TEMP TABLE charnames (CharName TEXT PRIMARY KEY)'
+    }
+
+# SQLite stand-in stored procedures, @pollinterval is in seconds as passed by the monitors
+SQLITE_PROCEDURES = {
+    'rocp_admin_charinfo_db': """
+        SELECT CharName, mapname, xPos, yPos, GID, AID, job, clevel, joblevel, jobpoint,
+          sppoint, exp, jobexp, money, email FROM charinfo
+        """,
+    'rocp_admin_charinfo_hash_db': """
+        SELECT CharName, mapname || '|' || xPos || '|' || yPos || '|' || job || '|' || clevel
+          || '|' || joblevel || '|' || jobpoint || '|' || sppoint || '|' || exp || '|' || jobexp
+          || '|' || money || '|' || email FROM charinfo
+        """,
+    'rocp_admin_charinfo_delta_db': """
+        SELECT charinfo.CharName, mapname, xPos, yPos, GID, AID, job, clevel, joblevel, jobpoint,
+          sppoint, exp, jobexp, money, email FROM charinfo
+          INNER JOIN charnames ON charnames.CharName=charinfo.CharName
+        """,
+    'rocp_admin_itemlog_db': """
+        SELECT srcCharName, srcCharID, srcAccountID, Action FROM ItemLog
+          WHERE logtime > datetime('now', 'localtime', '-' || :pollinterval || ' seconds')
+        """,
+    'rocp_admin_itemlog_since_db': """
+        SELECT srcCharName, srcCharID, srcAccountID, Action, LogID FROM ItemLog
+          WHERE (:watermark IS NULL AND logtime > datetime('now', 'localtime', '-' || :pollinterval || ' seconds'))
+          OR LogID > :watermark
+        """,
+    'rocp_admin_itemlog_watermark_db': """
+        SELECT MAX(LogID) FROM ItemLog
+        """
+    }
+
+# Errors of a failed poll query, of either importable driver
+QUERY_ERRORS = (sqlite3.Error,) if pyodbc is None else (pyodbc.Error, sqlite3.Error)
+
+
+def is_timeout(error):
+    """
+    Return whether a query error is the query exceeding its lease's query_timeout.
+    """
+    if pyodbc is not None and isinstance(error, pyodbc.OperationalError):
+        return error.args[0] == 'HYT00'
+    if isinstance(error, sqlite3.OperationalError):
+        return str(error) == 'interrupted'
+    return False
+
+
+class ConnectionManager:
+    """
+    Long-lived pyodbc connection with a liveness probe, reconnect backoff,
+    and one cached cursor per statement so prepared statements are reused.
+    """
+    def __init__(self, server, username, password, database, histograms=None,
+                 backoff_initial=1, backoff_max=60):
+        if pyodbc is None:
+            raise ImportError('DB_DRIVER=mssql requires pyodbc and unixODBC, use DB_DRIVER=sqlite without them')
+        self.server = server
+        self.connection_string = (
+            'DRIVER={driver};SERVER={server};DATABASE={database};UID={username};PWD={password}'.format(
+                driver='{ODBC Driver 17 for SQL Server}',
+                server=server,
+                database=database,
+                username=username,
+                password=password
+                )
+            )
+        self.histograms = histograms
+        self.query_timeout = 0
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+        self.connection = None
+        self.cursors = {}
+
+    def connect(self):
+        """
+        Open connection to database, retrying with exponential backoff.
+        With a query_timeout, login is bounded by it and not retried.
+        """
+        backoff = self.backoff_initial
+        while True:
+            logging.debug('Opening connection to %s', self.server)
+            time_start = time.perf_counter()
+            try:
+                self.connection = pyodbc.connect(self.connection_string, timeout=self.query_timeout)
+            except pyodbc.Error as error:
+                # Fail fast, leaving retries to the monitor's circuit breaker
+                if self.query_timeout:
+                    raise
+                logging.error(
+                    'Unable to connect to %s, retrying in %s seconds: %s',
+                    self.server,
+                    backoff,
+                    error
+                    )
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.backoff_max)
+                continue
+
+            if self.histograms is not None:
+                self.histograms['connect'].observe(time.perf_counter() - time_start)
+            return self.connection
+
+    def close(self):
+        """
+        Close connection and drop cached cursors.
+        """
+        if self.connection is not None:
+            logging.debug('Closing connection to %s', self.server)
+            try:
+                self.connection.close()
+            except pyodbc.Error:
+                pass
+        self.connection = None
+        self.cursors = {}
+
+    def is_alive(self):
+        """
+        Return whether the connection answers a cheap probe query.
+        """
+        if self.connection is None:
+            return False
+        try:
+            self.connection.execute('SELECT 1').fetchall()
+        except pyodbc.Error:
+            return False
+        return True
+
+    def execute(self, sql, *params):
+        """
+        Execute sql on its cached cursor and return the cursor for fetching.
+        Reconnects if the probe fails, and retries once if the connection
+        drops between the probe and the query.  Queries running longer than
+        query_timeout seconds, if set, raise pyodbc.OperationalError HYT00.
+        """
+        if not self.is_alive():
+            self.close()
+            self.connect()
+
+        # pyodbc applies the connection timeout to cursors as they are created
+        if self.connection.timeout != self.query_timeout:
+            self.connection.timeout = self.query_timeout
+            self.cursors = {}
+
+        for attempt in (1, 2):
+            # pyodbc reuses the prepared statement when a cursor re-executes identical sql
+            if sql not in self.cursors:
+                self.cursors[sql] = self.connection.cursor()
+            cursor = self.cursors[sql]
+
+            time_start = time.perf_counter()
+            try:
+                cursor.execute(sql, *params)
+            except (pyodbc.OperationalError, pyodbc.InterfaceError) as error:
+                if attempt == 2 or is_timeout(error):
+                    raise
+                logging.error('Connection to %s lost, reconnecting: %s', self.server, error)
+                self.close()
+                self.connect()
+                continue
+
+            if self.histograms is not None:
+                self.histograms['query'].observe(time.perf_counter() - time_start)
+            return cursor
+
+
+class SQLiteConnectionManager:
+    """
+    ConnectionManager stand-in backed by a SQLite database file (or ':memory:')
+    in place of the Aegis database.  Stored procedure calls are translated to
+    SQLITE_PROCEDURES, and table-valued parameters are loaded into temporary
+    tables of SQLITE_TABLE_TYPES.
+    """
+    def __init__(self, server, username, password, database, histograms=None,
+                 backoff_initial=1, backoff_max=60):
+        self.server = database
+        self.database = database
+        self.histograms = histograms
+        self.query_timeout = 0
+        self.connection = None
+
+    def connect(self):
+        """
+        Open database file, creating stand-in tables if absent.
+        """
+        logging.debug('Opening SQLite database %s', self.database)
+        time_start = time.perf_counter()
+        # Autocommit, so no transaction outlives a query and holds the database locked from writers
+        self.connection = sqlite3.connect(self.database, check_same_thread=False, isolation_level=None)
+        self.connection.executescript(SQLITE_SCHEMA)
+        if self.histograms is not None:
+            self.histograms['connect'].observe(time.perf_counter() - time_start)
+        return self.connection
+
+    def close(self):
+        """
+        Close database file.
+        """
+        if self.connection is not None:
+            self.connection.close()
+        self.connection = None
+
+    def is_alive(self):
+        """
+        Return whether the database file is open.
+        """
+        return self.connection is not None
+
+    def execute(self, sql, *params):
+        """
+        Execute the stored procedure call sql, e.g. 'EXEC procedure @name = ?',
+        and return the cursor for fetching.  Queries, including fetching,
+        running longer than query_timeout seconds, if set, are interrupted.
+        """
+        if not self.is_alive():
+            self.connect()
+
+        if self.query_timeout:
+            deadline = time.perf_counter() + self.query_timeout
+            self.connection.set_progress_handler(lambda: time.perf_counter() > deadline, 10000)
+        else:
+            self.connection.set_progress_handler(None, 0)
+
+        procedure, arguments = re.fullmatch(r'(?:EXEC\s+)?(\w+)(.*)', sql.strip()).groups()
+        arguments = dict(zip(re.findall(r'@(\w+)\s*=\s*\?', arguments), params))
+
+        # Load table-valued parameters, passed as [rows], into temporary tables in one transaction
+        for name, value in list(arguments.items()):
+            if isinstance(value, list):
+                self.connection.execute('DROP TABLE IF EXISTS temp.{}'.format(name))
+                self.connection.execute(SQLITE_TABLE_TYPES[name])
+                rows = value[0]
+                if rows:
+                    with self.connection:
+                        self.connection.execute('BEGIN')
+                        self.connection.executemany(
+                            'INSERT INTO temp.{} VALUES ({})'.format(name, ', '.join('?' * len(rows[0]))),
+                            rows
+                            )
+                del arguments[name]
+
+        time_start = time.perf_counter()
+        cursor = self.connection.execute(SQLITE_PROCEDURES[procedure], arguments)
+        if self.histograms is not None:
+            self.histograms['query'].observe(time.perf_counter() - time_start)
+        return cursor
+
+
+# Connection managers, keyed by DB_DRIVER
+DRIVERS = {
+    'mssql': ConnectionManager,
+    'sqlite': SQLiteConnectionManager
+    }
+
+
+class ConnectionPool:
+    """
+    Up to 'size' connections of one DB_DRIVER, opened on demand and leased
+    for the duration of a poll.  Monitors sharing a pool share connections,
+    waiting for a free one rather than each opening their own.
+    """
+    def __init__(self, driver, server, username, password, database, size=1):
+        self.connection_args = {
+            'server': server,
+            'username': username,
+            'password': password,
+            'database': database
+            }
+        self.driver = driver
+        self.size = size
+        self.created = 0
+        self.lock = threading.Lock()
+        self.connections = queue.LifoQueue()
+
+    @contextlib.contextmanager
+    def acquire(self, histograms=None, query_timeout=0):
+        """
+        Lease a connection, observing its latency in the leasing monitor's
+        histograms and bounding its queries by the monitor's query_timeout.
+        """
+        with self.lock:
+            if self.connections.empty() and self.created < self.size:
+                self.connections.put(DRIVERS[self.driver](**self.connection_args))
+                self.created += 1
+        connection = self.connections.get()
+        connection.histograms = histograms
+        connection.query_timeout = query_timeout
+        try:
+            yield connection
+        finally:
+            self.connections.put(connection)
+
+
+class CircuitBreaker:
+    """
+    Stops polling a database after 'failures' consecutive failed fetches,
+    for 'reset_timeout' seconds before a trial fetch, so a slow or down
+    database does not hold up every poll.  Exports fetch failures and the
+    age of the last good snapshot, prefixed by 'prefix', to registry.
+    Disabled when 'failures' is 0.
+    """
+    def __init__(self, prefix, failures, reset_timeout, registry=prometheus_client.REGISTRY):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.consecutive = 0
+        self.time_opened = None
+        self.time_success = time.time()
+        self.metrics = {
+            'failures': prometheus_client.Counter(
+                name=prefix + '_poll_failures',
+                documentation='Polls without a fresh snapshot, by reason',
+                labelnames=['reason'],
+                registry=registry
+                ),
+            'age': prometheus_client.Gauge(
+                name=prefix + '_snapshot_age_seconds',
+                documentation='Seconds since the served snapshot was fetched',
+                registry=registry
+                ),
+            'open': prometheus_client.Gauge(
+                name=prefix + '_circuit_open',
+                documentation='Whether polling is suspended after consecutive failures',
+                registry=registry
+                )
+            }
+        self.metrics['age'].set_function(lambda: time.time() - self.time_success)
+
+    def allow(self):
+        """
+        Return whether to fetch, counting a skipped poll if the circuit is open.
+        """
+        if self.time_opened is None or time.time() - self.time_opened >= self.reset_timeout:
+            return True
+        logging.warning('Circuit open, serving snapshot fetched %.0f seconds ago', time.time() - self.time_success)
+        self.metrics['failures'].labels(reason='circuit_open').inc()
+        return False
+
+    def success(self):
+        """
+        Record a fetched snapshot, closing the circuit.
+        """
+        if self.time_opened is not None:
+            logging.info('Circuit closed, database recovered')
+            self.time_opened = None
+            self.metrics['open'].set(0)
+        self.consecutive = 0
+        self.time_success = time.time()
+
+    def failure(self, error):
+        """
+        Record a failed fetch, opening the circuit after 'failures' in a row
+        or when a trial fetch fails.
+        """
+        reason = 'timeout' if is_timeout(error) else 'error'
+        logging.error('Fetch failed (%s), serving the last snapshot: %s', reason, error)
+        self.metrics['failures'].labels(reason=reason).inc()
+        self.consecutive += 1
+        if self.failures and self.consecutive >= self.failures:
+            if self.time_opened is None:
+                logging.warning('Circuit opened after %s failures, retrying in %s seconds',
+                                self.consecutive, self.reset_timeout)
+            self.time_opened = time.time()
+            self.metrics['open'].set(1)
+
+
+def parse_shards(shards, password, secrets='/run/secrets'):
+    """
+    Return the name, hostname, database, and password of each DB_SHARDS
+    entry, whitespace separated 'name:hostname:database' entries.  A shard's
+    password is read from secret DB_PASSWORD_<name> if present, else shared.
+    """
+    parsed = []
+    for shard in shards.split():
+        name, hostname, database = shard.split(':', 2)
+        if name in (parsed_name for parsed_name, *_ in parsed):
+            raise ValueError('DB_SHARDS names must be unique, {} is repeated'.format(name))
+        secret = os.path.join(secrets, 'DB_PASSWORD_' + name)
+        if os.path.exists(secret):
+            with open(secret) as secret_fp:
+                parsed.append((name, hostname, database, secret_fp.read()))
+        else:
+            parsed.append((name, hostname, database, password))
+    return parsed
+
+
+def shard_file(path, shard):
+    """
+    Return the shard's own copy of a state or watermark file path, '' if unset.
+    """
+    return '{}.{}'.format(path, shard) if path else ''
+
+
+class ShardCollector:
+    """
+    Prometheus collector exposing the metrics of every shard's registry,
+    merged into one family per metric and labelled by shard.
+    """
+    def __init__(self, registries):
+        self.registries = registries
+
+    def collect(self):
+        """
+        Yield each metric family with the samples of every shard.
+        """
+        families = {}
+        for shard, registry in self.registries.items():
+            for metric in registry.collect():
+                if metric.name not in families:
+                    families[metric.name] = prometheus_client.Metric(
+                        metric.name,
+                        metric.documentation,
+                        metric.type,
+                        metric.unit
+                        )
+                families[metric.name].samples.extend(
+                    sample._replace(labels=dict(sample.labels, shard=shard)) for sample in metric.samples
+                    )
+
+        yield from families.values()
+
+
+class ShardLogFilter(logging.Filter):
+    """
+    Prefix log lines of shard polling threads, named after their shard.
+    """
+    def filter(self, record):
+        if record.threadName != 'MainThread':
+            record.msg = '[{}] {}'.format(record.threadName.replace('%', '%%'), record.msg)
+        return True
+
+
+def run_shards(setup, run, shards, driver, username, config, files=()):
+    """
+    Poll each shard concurrently, in a thread named after it, so a poll tick
+    takes as long as the slowest shard rather than all of them.  Each thread
+    runs run(setup(pool, registry, **config)) with the shard's own connection
+    pool, metrics registry, and copy of each config file path in files.  The
+    shards' metrics are exposed in the default registry, labelled by shard,
+    and their memory accounting reported under the shard's name.  A setup
+    must register its memory accounting only once it can no longer fail,
+    as a failed setup is retried from scratch.  A shard failing is logged, marked down, and restarted after
+    SHARD_RESTART_DELAY seconds, the other shards polling meanwhile.
+    """
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(ShardLogFilter())
+
+    registries = {name: prometheus_client.CollectorRegistry() for name, *_ in shards}
+    prometheus_client.REGISTRY.register(ShardCollector(registries))
+    shard_up = prometheus_client.Gauge(
+        name='aegis_shard_up',
+        documentation='Whether each shard is polling, 0 while it restarts after an error',
+        labelnames=['shard']
+        )
+
+    def run_shard(name, hostname, database, password):
+        pool = ConnectionPool(
+            driver=driver,
+            server=hostname,
+            username=username,
+            password=password,
+            database=database
+            )
+        shard_config = dict(config, **{key: shard_file(config[key], name) for key in files})
+        monitor = None
+        while True:
+            shard_up.labels(shard=name).set(1)
+            try:
+                # A failed setup may have registered some metrics, retry it with a fresh registry
+                if monitor is None:
+                    registries[name] = prometheus_client.CollectorRegistry()
+                    monitor = setup(pool=pool, registry=registries[name], **shard_config)
+                    monitor['memory'].shard = name
+                run(monitor)
+            except Exception:  # pylint: disable=broad-except
+                logging.exception('Shard failed, restarting in %s seconds', SHARD_RESTART_DELAY)
+            shard_up.labels(shard=name).set(0)
+            time.sleep(SHARD_RESTART_DELAY)
+
+    threads = [threading.Thread(target=run_shard, args=shard, name=shard[0], daemon=True) for shard in shards]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def save_state(state_file, version, state):
+    """
+    Atomically persist monitor state, tagged with its schema version, so a
+    crash mid-write leaves the previous state file intact.
+    """
+    with open(state_file + '.tmp', 'wb') as state_fp:
+        state_fp.write(STATE_HEADER.pack(STATE_MAGIC, version))
+        pickle.dump(state, state_fp, protocol=pickle.HIGHEST_PROTOCOL)
+        state_fp.flush()
+        os.fsync(state_fp.fileno())
+    os.replace(state_file + '.tmp', state_file)
+
+
+def load_state(state_file, version, restore=lambda state: state):
+    """
+    Return persisted monitor state converted by restore(state), or None if
+    none has been stored, or it was stored with another schema version, is
+    unreadable, or is not of the shape restore expects.
+    """
+    try:
+        with open(state_file, 'rb') as state_fp:
+            magic, state_version = STATE_HEADER.unpack(state_fp.read(STATE_HEADER.size))
+            if magic != STATE_MAGIC or state_version != version:
+                logging.warning(
+                    'Ignoring state file %s with schema version %s, expected %s',
+                    state_file,
+                    state_version,
+                    version
+                    )
+                return None
+            state = pickle.load(state_fp)
+    except FileNotFoundError:
+        return None
+    except (struct.error, pickle.UnpicklingError, EOFError, ValueError, AttributeError, ImportError) as error:
+        logging.warning('Ignoring unreadable state file %s: %s', state_file, error)
+        return None
+
+    try:
+        return restore(state)
+    except (KeyError, IndexError, AttributeError, TypeError, ValueError) as error:
+        logging.warning('Ignoring state file %s of unexpected shape: %r', state_file, error)
+        return None
@@ -0,0 +1,175 @@
+"""
+Memory accounting for Aegis monitor state.
+Reports entry counts and approximate bytes of each monitor's internal
+structures, and the labelled children of each of its gauges, as gauges
+prefixed by the monitor.  Bytes are estimated from a sample of entries, so
+accounting costs the same regardless of the number of characters.
+The latest accounting, and optionally the top tracemalloc allocators, are
+served as text at /memory, see start_memory_server.
+Shared by m_active and m_itemlog.
+"""
+import http.server
+import itertools
+import sys
+import threading
+import tracemalloc
+from array import array
+import prometheus_client
+
+# Entries sampled per container when estimating its size
+SAMPLE_SIZE = 64
+
+# Allocators listed at /memory when tracemalloc is tracing
+TOP_ALLOCATORS = 25
+
+# Accounts of this process, served together at /memory
+ACCOUNTS = []
+
+
+def approximate_bytes(obj, sample_size=SAMPLE_SIZE):
+    """
+    Return the approximate deep size of obj in bytes.  Containers longer
+    than sample_size are sized by their first sample_size entries, objects
+    shared between entries are counted once per reference.
+    """
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (str, bytes, array)):
+        return size
+
+    if isinstance(obj, dict):
+        entries = obj.items()
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        entries = obj
+    elif hasattr(obj, '__dict__'):
+        return size + approximate_bytes(vars(obj), sample_size)
+    else:
+        return size
+
+    sample = list(itertools.islice(entries, sample_size))
+    if not sample:
+        return size
+    if isinstance(obj, dict):
+        sample_bytes = sum(
+            approximate_bytes(key, sample_size) + approximate_bytes(value, sample_size)
+            for key, value in sample
+            )
+    else:
+        sample_bytes = sum(approximate_bytes(entry, sample_size) for entry in sample)
+    return size + sample_bytes * len(obj) // len(sample)
+
+
+def metric_children(metric):
+    """
+    Return the number of labelled children of metric, 0 if it has no labels.
+    """
+    # prometheus_client keeps labelled children in the private _metrics dict, with no public count
+    return len(getattr(metric, '_metrics', ()))
+
+
+class MemoryAccounting:
+    """
+    Size gauges of a monitor's structures and metrics, prefixed by 'prefix', in registry.
+    Reported at /memory under the prefix, followed by the monitor's shard if set.
+    """
+    def __init__(self, prefix, metrics, registry=prometheus_client.REGISTRY):
+        self.prefix = prefix
+        self.shard = None
+        self.metrics = metrics
+        self.latest = {}
+        self.gauges = {
+            'entries': prometheus_client.Gauge(
+                name=prefix + '_state_entries',
+                documentation='Entries held in each internal structure',
+                labelnames=['structure'],
+                registry=registry
+                ),
+            'bytes': prometheus_client.Gauge(
+                name=prefix + '_state_bytes',
+                documentation='Approximate bytes held by each internal structure',
+                labelnames=['structure'],
+                registry=registry
+                ),
+            'children': prometheus_client.Gauge(
+                name=prefix + '_metric_children',
+                documentation='Labelled children of each gauge',
+                labelnames=['metric'],
+                registry=registry
+                )
+            }
+        ACCOUNTS.append(self)
+
+    def account(self, structures, entries=None):
+        """
+        Update size gauges of structures, a dictionary of containers keyed
+        by name, and of the metrics' children.  Entries are counted by len()
+        unless given in entries, keyed by structure name.
+        """
+        entries = entries or {}
+        latest = {}
+        for name, structure in structures.items():
+            latest[name] = (entries.get(name, len(structure)), approximate_bytes(structure))
+            self.gauges['entries'].labels(structure=name).set(latest[name][0])
+            self.gauges['bytes'].labels(structure=name).set(latest[name][1])
+        for name, metric in self.metrics.items():
+            self.gauges['children'].labels(metric=name).set(metric_children(metric))
+        self.latest = latest
+
+    def report(self):
+        """
+        Return the latest accounting as lines of text.
+        """
+        prefix = self.prefix if self.shard is None else '{}[{}]'.format(self.prefix, self.shard)
+        lines = ['{} {:30} {:>10} entries {:>14} bytes'.format(prefix, name, count, size)
+                 for name, (count, size) in self.latest.items()]
+        children = sum(metric_children(metric) for metric in self.metrics.values())
+        lines.append('{} {:30} {:>10} children'.format(prefix, 'metrics', children))
+        return lines
+
+
+class MemoryHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serve the latest accounting of every monitor, and the top tracemalloc
+    allocators when tracing, at /memory.
+    """
+    def do_GET(self):  # pylint: disable=invalid-name
+        """
+        Respond to GET /memory.
+        """
+        if self.path != '/memory':
+            self.send_error(404)
+            return
+
+        lines = [line for account in ACCOUNTS for line in account.report()]
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            lines.append('tracemalloc {} bytes traced, {} bytes peak'.format(current, peak))
+            statistics = tracemalloc.take_snapshot().statistics('lineno')
+            lines.extend(str(statistic) for statistic in statistics[:TOP_ALLOCATORS])
+        body = '\n'.join(lines).encode() + b'\n'
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """
+        Do not log requests.
+        """
+
+
+def start_memory_server(port, tracemalloc_frames=0):
+    """
+    Serve /memory on port from a background thread, disabled when port is 0.
+    Trace allocations with tracemalloc_frames frames of traceback, disabled
+    when 0 as tracing slows every allocation.
+    """
+    if tracemalloc_frames:
+        tracemalloc.start(tracemalloc_frames)
+    if not port:
+        return None
+
+    server = http.server.ThreadingHTTPServer(('', port), MemoryHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
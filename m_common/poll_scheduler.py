@@ -0,0 +1,269 @@
+"""
+Drift-free poll scheduler for Aegis monitors.
+Polls run on fixed wall-clock ticks every 'interval' seconds, offset by
+'phase' seconds, rather than sleeping 'interval' after each poll, so the
+poll period does not grow with query and processing time.  A poll running
+past its next tick skips the missed ticks instead of running back to back.
+Polls may time their phases, and be profiled with cProfile on demand, see
+profile_on_signal.  Polls split into fetch and process stages may be
+pipelined, fetching the next poll while the last is processed, see run_pipelined.
+Counters windowed by calendar week, day, and hour are tagged with
+window_epochs.  Shared by m_active, m_itemlog, and m_tls_expiry.
+"""
+import asyncio
+import collections
+import cProfile
+import logging
+import os
+import queue
+import signal
+import threading
+import time
+import prometheus_client
+
+# Schedulers of this process, profiled together on signal
+SCHEDULERS = []
+
+# Held while a poll of any scheduler is being profiled
+PROFILE_LOCK = threading.Lock()
+
+
+def window_epochs(time_now):
+    """
+    Return the calendar-aligned week (from monday), day, and hour epochs of time_now.
+    """
+    day = time_now.toordinal()
+    return {
+        # Ordinal 1, 0001-01-01, is a monday
+        'week': (day - 1) // 7,
+        'day': day,
+        'hour': day * 24 + time_now.hour
+        }
+
+
+class PollScheduler:
+    """
+    Wall-clock poll ticks at phase + k * interval seconds since the epoch,
+    exporting poll lag, overruns, and duration prefixed by 'prefix' to registry.
+    """
+    def __init__(self, prefix, interval, phase=0, not_before=0, registry=prometheus_client.REGISTRY):
+        self.prefix = prefix
+        self.interval = interval
+        self.phase = phase
+        self.next_tick = self.tick_after(max(time.time(), not_before))
+        self.time_start = None
+        self.profile_polls = 0
+        self.profile_file = None
+        self.profiler = None
+        self.metrics = {
+            'lag': prometheus_client.Gauge(
+                name=prefix + '_poll_lag_seconds',
+                documentation='Delay between the scheduled tick and the start of the last poll',
+                registry=registry
+                ),
+            'overruns': prometheus_client.Counter(
+                name=prefix + '_poll_overruns',
+                documentation='Poll ticks skipped because the previous poll was still running',
+                registry=registry
+                ),
+            'duration': prometheus_client.Histogram(
+                name=prefix + '_poll_duration_seconds',
+                documentation='Time spent polling',
+                registry=registry
+                ),
+            'phase': prometheus_client.Histogram(
+                name=prefix + '_poll_phase_seconds',
+                documentation='Time spent in each phase of polling',
+                labelnames=['phase'],
+                registry=registry
+                )
+            }
+        SCHEDULERS.append(self)
+
+    def tick_after(self, time_now):
+        """
+        Return the first tick at or after time_now.
+        """
+        ticks = -((self.phase - time_now) // self.interval)
+        return self.phase + ticks * self.interval
+
+    def start(self):
+        """
+        Record the start of a poll and its lag behind the scheduled tick.
+        """
+        self.time_start = time.time()
+        self.metrics['lag'].set(max(self.time_start - self.next_tick, 0))
+
+    def wait(self):
+        """
+        Sleep until the next tick, then start the poll.
+        """
+        time.sleep(max(self.next_tick - time.time(), 0))
+        self.start()
+
+    async def wait_async(self):
+        """
+        Sleep until the next tick without blocking the event loop, then start the poll.
+        """
+        await asyncio.sleep(max(self.next_tick - time.time(), 0))
+        self.start()
+
+    def time_phase(self, phase):
+        """
+        Return a context manager observing its duration as poll phase 'phase'.
+        """
+        return self.metrics['phase'].labels(phase=phase).time()
+
+    def request_profile(self, polls, profile_file):
+        """
+        Profile the next 'polls' polls, writing their combined stats to profile_file.
+        """
+        if self.profile_polls:
+            logging.warning('Already profiling %s polls to %s', self.profile_polls, self.profile_file)
+            return
+        logging.info('Profiling the next %s polls to %s', polls, profile_file)
+        self.profile_file = profile_file
+        self.profile_polls = polls
+
+    def profile_done(self):
+        """
+        Count a profiled poll, writing the stats once the requested polls are profiled.
+        """
+        self.profile_polls -= 1
+        if not self.profile_polls:
+            try:
+                self.profiler.dump_stats(self.profile_file)
+                logging.info('Wrote poll profile %s', self.profile_file)
+            except OSError as error:
+                logging.warning('Could not write poll profile %s: %s', self.profile_file, error)
+            self.profiler = None
+
+    def start_profiler(self):
+        """
+        Return whether this poll is profiled, starting the profiler if
+        profiling was requested and no other poll of the process is being
+        profiled.  A process runs one profiler at a time, Python 3.12
+        refuses a second, so polls of other schedulers meanwhile run unprofiled.
+        """
+        if not self.profile_polls or not PROFILE_LOCK.acquire(blocking=False):
+            return False
+        self.profiler = self.profiler or cProfile.Profile()
+        try:
+            self.profiler.enable()
+        except ValueError as error:
+            PROFILE_LOCK.release()
+            logging.warning('Not profiling poll: %s', error)
+            return False
+        return True
+
+    def stop_profiler(self):
+        """
+        Stop the profiler started by start_profiler and count the profiled poll.
+        """
+        self.profiler.disable()
+        PROFILE_LOCK.release()
+        self.profile_done()
+
+    def profiled(self, poll, *args):
+        """
+        Run poll(*args), under cProfile if profiling was requested.
+        """
+        if not self.start_profiler():
+            return poll(*args)
+        try:
+            return poll(*args)
+        finally:
+            self.stop_profiler()
+
+    async def profiled_async(self, poll, monitor):
+        """
+        Await poll(monitor), under cProfile if profiling was requested.
+        Profiles the event loop thread, including other tasks run meanwhile.
+        """
+        if not self.start_profiler():
+            return await poll(monitor)
+        try:
+            return await poll(monitor)
+        finally:
+            self.stop_profiler()
+
+    def finish(self):
+        """
+        Record the end of a poll and schedule the next tick, skipping ticks
+        passed while polling.  Return seconds until the next tick.
+        """
+        time_now = time.time()
+        self.metrics['duration'].observe(time_now - self.time_start)
+
+        next_tick = self.tick_after(time_now)
+        skipped = round((next_tick - self.next_tick) / self.interval) - 1
+        if skipped > 0:
+            logging.warning('Poll overran its interval, skipping %s ticks', skipped)
+            self.metrics['overruns'].inc(skipped)
+        self.next_tick = max(next_tick, self.next_tick + self.interval)
+        return self.next_tick - time_now
+
+
+def profile_on_signal(polls, directory, signum=signal.SIGUSR1):
+    """
+    Profile the next 'polls' polls of every scheduler when signum is
+    received, writing <prefix>-<time>.prof stats files to directory, numbered
+    <prefix>-<n>-<time>.prof after the first scheduler of a prefix, e.g. shards.
+    Polls run unprofiled, at no cost, until then.
+    """
+    def request_profiles(*_):
+        time_now = int(time.time())
+        prefixes = collections.Counter()
+        for scheduler in SCHEDULERS:
+            name = scheduler.prefix
+            if prefixes[scheduler.prefix]:
+                name = '{}-{}'.format(scheduler.prefix, prefixes[scheduler.prefix])
+            prefixes[scheduler.prefix] += 1
+            scheduler.request_profile(
+                polls,
+                os.path.join(directory, '{}-{}.prof'.format(name, time_now))
+                )
+
+    signal.signal(signum, request_profiles)
+
+
+def run_pipelined(scheduler, fetch, process, monitor, depth=1):
+    """
+    Poll monitor forever, fetch(monitor) on the scheduler's ticks in a
+    background thread and process(monitor, fetched) on the calling thread.
+    Up to 'depth' fetched polls wait for processing, a fetch blocks once
+    processing falls that far behind and its missed ticks are skipped.
+    The poll period is then bound by the slower stage rather than both.
+    An error in either stage stops both, and is raised.
+    """
+    fetched_queue = queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+
+    def fetch_worker():
+        while True:
+            scheduler.wait()
+            if stopped.is_set():
+                return
+            try:
+                fetched = fetch(monitor)
+            except Exception as error:  # pylint: disable=broad-except
+                fetched_queue.put((None, error))
+                return
+            fetched_queue.put((fetched, None))
+            logging.info('Fetch complete, sleeping %.0f seconds', scheduler.finish())
+
+    threading.Thread(target=fetch_worker, name=threading.current_thread().name + ' fetch', daemon=True).start()
+    try:
+        while True:
+            fetched, error = fetched_queue.get()
+            if error is not None:
+                raise error
+            scheduler.profiled(process, monitor, fetched)
+            logging.info('Iteration complete')
+    finally:
+        # Free a slot for a fetch blocked on the queue, the worker then sees it is stopped
+        stopped.set()
+        try:
+            fetched_queue.get_nowait()
+        except queue.Empty:
+            pass
@@ -6,370 +6,770 @@ hour, consecutive, and current (now) granularity every 'poll_interval'.
 v1.0.0 Koko - 20/05/27
 """
 import os
+import sys
 import logging
 import time
 import datetime
-import pyodbc
+import functools
+import json
+import threading
+from array import array
 import prometheus_client
+import prometheus_client.core
+
+# Modules shared by the monitors
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'm_common'))
+import activity_log  # noqa: E402
+import aegis_db  # noqa: E402
+import memory_accounting  # noqa: E402
+import poll_scheduler  # noqa: E402
 
 if bool(os.getenv('DEBUG')):
     logging.basicConfig(format='%(asctime)s %(message)s', level=logging.DEBUG)
 else:
     logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
 
+# Index of each counter within a character action's counter array, week,
+# day, and hour counters are tagged with the epoch they count
+COUNTERS = {
+    'week': 0,
+    'day': 1,
+    'hour': 2,
+    'consecutive': 3,
+    'now': 4,
+    'week_epoch': 5,
+    'day_epoch': 6,
+    'hour_epoch': 7
+    }
+
+# Persisted state schema version, increment whenever the state, itemlog_active entries, or COUNTERS change
+STATE_VERSION = 2
+
+# Itemlog action gauge names and documentation, keyed by ItemLog Action
+ACTIONS = {
+    0: ('item_drop', 'Items removed by character drop'),
+    1: ('item_pickup', 'Items created by character pickup'),
+    2: ('item_consumed', 'Items consumed by character'),
+    3: ('item_traded', 'Items traded between characters'),
+    4: ('item_bought_pc', 'Items moved by purchase from PC'),
+    5: ('item_bought_npc', 'Items created by purchase from NPC'),
+    6: ('item_sold_npc', 'Items consumed by sell to NPC'),
+    7: ('item_mvp', 'Items created by MVP rewards'),
+    8: ('item_stolen', 'Items created by steal'),
+    9: ('item_misc_1', 'Items consumed by misc_1 e.g. endow skills, pet capture, etc.'),
+    10: ('item_misc_2', 'N/A'),
+    11: ('item_npc_compulsive', 'Items created by compulsive NPCs'),
+    12: ('item_npc_event', 'Items created by event NPCs'),
+    13: ('item_gm', 'Items created by GMs using /item'),
+    14: ('item_box', 'Items created by OCAs, OPBs, OBBs, etc.'),
+    15: ('item_blacksmith', 'Items created by Blacksmiths'),
+    16: ('item_npc_give', 'Items created by NPC e.g. quest'),
+    17: ('item_npc_take', 'Items consumed by NPC e.g. quest, refine, etc.'),
+    18: ('zeny_npc', 'Zeny consumed/created by NPC'),
+    19: ('item_inv_to_kafra', 'Items moved to Kafra storage from character inventory'),
+    20: ('item_inv_to_cart', 'Items moved to Cart from character inventory'),
+    21: ('item_kafra_to_inv', 'Items moved to character inventory from Kafra storage'),
+    22: ('item_kafra_to_cart', 'Items moved to Kafra storage from character cart'),
+    23: ('item_cart_to_inv', 'Items moved to character cart from character inventory money'),
+    24: ('item_cart_to_kafra', 'Items moved to character cart from Kafra storage'),
+    35: ('item_cash_buy', 'Items created by purchase from cashshop NPC'),
+    36: ('item_cash_box', 'Items created by a cashshop box')
+    }
+
+
+def window_value(counters, window, epochs):
+    """
+    Return the week, day, or hour counter of counters, 0 if counted in an earlier epoch.
+    """
+    if counters[COUNTERS[window + '_epoch']] != epochs[window]:
+        return 0
+    return counters[COUNTERS[window]]
+
 
-def gen_itemlog_db(server, username, password, database, action_keys, poll_interval):
+def load_watermark(watermark_file):
     """
-    Return character itemlog activity from ItemLog table.
+    Return the persisted itemlog watermark, or None if none has been stored.
     """
-    # Create a new connection to database
-    logging.debug('Opening connection to %s', server)
-    connection = pyodbc.connect(
-        'DRIVER={driver};SERVER={server};DATABASE={database};UID={username};PWD={password}'.format(
-            driver='{ODBC Driver 17 for SQL Server}',
-            server=server,
-            database=database,
-            username=username,
-            password=password
-            )
+    try:
+        with open(watermark_file) as watermark_fp:
+            stored = json.load(watermark_fp)
+    except FileNotFoundError:
+        return None
+
+    if stored['type'] == 'datetime':
+        return datetime.datetime.fromisoformat(stored['value'])
+    return stored['value']
+
+
+def save_watermark(watermark_file, watermark):
+    """
+    Atomically persist the itemlog watermark so a restart resumes from it.
+    """
+    if isinstance(watermark, datetime.datetime):
+        stored = {'type': 'datetime', 'value': watermark.isoformat()}
+    else:
+        stored = {'type': 'int', 'value': int(watermark)}
+
+    with open(watermark_file + '.tmp', 'w') as watermark_fp:
+        json.dump(stored, watermark_fp)
+        watermark_fp.flush()
+        os.fsync(watermark_fp.fileno())
+    os.replace(watermark_file + '.tmp', watermark_file)
+
+
+def restore_active(state_file, gauges, drop_zero=False):
+    """
+    Return itemlog_active and the watermark of the rows it counts restored
+    from state_file, or an empty dictionary and None if no usable state is stored.
+    """
+    restored = aegis_db.load_state(
+        state_file,
+        STATE_VERSION,
+        lambda state: (dict(state['itemlog_active']), state['watermark'])
         )
+    if restored is None:
+        return {}, None
+    itemlog_active, watermark = restored
+    logging.info('Restored %s characters from %s', len(itemlog_active), state_file)
 
-    # Perform DB query
-    try: 
-        cursor = connection.cursor()
-        cursor.execute('EXEC rocp_admin_itemlog_db @pollinterval = ?', poll_interval)
-        results = cursor.fetchall()
-    except pyodbc.OperationalError:
-        logging.info('No itemlog updates in the last interval')
-        results = []
+    # Update itemlog gauges, optionally dropping zero-valued series
+    if gauges is not None:
+        for character, character_active in itemlog_active.items():
+            for action, counters in character_active['action'].items():
+                if counters[COUNTERS['now']] != 0 or not drop_zero:
+                    gauges[action].labels(
+                        character=character
+                        ).set(counters[COUNTERS['now']])
 
-    # Close connection
-    logging.debug('Closing connection to %s', server)
-    connection.close()
+    return itemlog_active, watermark
 
-    # Build itemlog_db
-    itemlog_db = {}
-    for result in results:
-        try:
-            # Attempt to increment action counter
-            itemlog_db[result[0]]['action'][result[3]] += 1
-        except KeyError:
-            # Initialize character in itemlog_db
-            itemlog_db[result[0]] = {
-                'id': {
-                    'GID': result[1],
-                    'AID': result[2]
-                    },
-                'action': {}
-                }
 
-            # Initialize action counters
-            for action in action_keys:
-                itemlog_db[result[0]]['action'][action] = 0
+def gen_itemlog_db(connection, action_keys, poll_interval, batch_size, watermark=None, incremental=False):
+    """
+    Return character itemlog activity from ItemLog table, and the new watermark.
+    Rows are streamed 'batch_size' at a time and counted as they arrive so
+    memory does not grow with the number of rows in the poll window.
+    The procedure may return one row per ItemLog entry, or rows already
+    aggregated by character and action with a trailing count column.
+    When 'incremental', only rows newer than 'watermark' are fetched and each
+    row carries its own watermark (logtime or identity key) as a last column.
+    Without a watermark yet, the newest row's watermark is read first, and
+    returned if the poll window holds no rows.
+    """
+    itemlog_db = {}
 
-            # Increment action counter
-            itemlog_db[result[0]]['action'][result[3]] += 1
+    # Seed the watermark before reading the window, so an empty first window does not leave polling on it
+    watermark_seed = None
+    if incremental and watermark is None:
+        cursor = connection.execute('EXEC rocp_admin_itemlog_watermark_db')
+        if cursor.description is not None:
+            watermark_seed = (cursor.fetchone() or [None])[0]
+
+    # Perform DB query, query errors are raised rather than taken for an empty interval
+    if incremental:
+        cursor = connection.execute(
+            'EXEC rocp_admin_itemlog_since_db @watermark = ?, @pollinterval = ?',
+            watermark,
+            poll_interval
+            )
+    else:
+        cursor = connection.execute('EXEC rocp_admin_itemlog_db @pollinterval = ?', poll_interval)
 
-    return itemlog_db
+    # A procedure returning no result set has no updates
+    if cursor.description is None:
+        logging.info('No itemlog updates in the last interval')
+        results = []
+    else:
+        # Incremental rows carry a trailing watermark column
+        columns = len(cursor.description) - 1 if incremental else len(cursor.description)
+        aggregated = columns == 5
+        results = cursor.fetchmany(batch_size)
+
+    # Build itemlog_db, counting only actions each character performed
+    while results:
+        for result in results:
+            if result[3] not in action_keys:
+                continue
+            count = result[4] if aggregated else 1
+            try:
+                # Attempt to increment action counter
+                actions = itemlog_db[result[0]]['action']
+            except KeyError:
+                # Initialize character in itemlog_db
+                itemlog_db[result[0]] = {
+                    'id': {
+                        'GID': result[1],
+                        'AID': result[2]
+                        },
+                    'action': {}
+                    }
+                actions = itemlog_db[result[0]]['action']
+            actions[result[3]] = actions.get(result[3], 0) + count
+
+        # Advance watermark to the newest row seen
+        if incremental:
+            batch_watermark = max(result[-1] for result in results)
+            if watermark is None or batch_watermark > watermark:
+                watermark = batch_watermark
+
+        results = cursor.fetchmany(batch_size)
+
+    if watermark is None:
+        watermark = watermark_seed
+    return itemlog_db, watermark
+
+
+def format_activity(itemlog_active, epochs, item):
+    """
+    Return the activity log line of an itemlog_active (character, action).
+    """
+    character, action = item
+    counters = itemlog_active[character]['action'][action]
+    return '{character:25} {action:20} c:{consecutive:3} h:{hour:3} d:{day:3} w:{week:3}'.format(
+        character=character,
+        action=ACTIONS[action][0],
+        consecutive=counters[COUNTERS['consecutive']],
+        hour=window_value(counters, 'hour', epochs),
+        day=window_value(counters, 'day', epochs),
+        week=window_value(counters, 'week', epochs)
+        )
 
 
-def update_active(itemlog_active, itemlog_db, gauges, action_keys):
+def update_active(itemlog_active, itemlog_db, epochs, activity=None):
     """
     Update itemlog_active dictionaries to latest itemlog counters.
+    Counters are kept sparsely, only for actions a character has performed,
+    as an array of COUNTERS.  Active characters are moved to the end of
+    itemlog_active, keeping it ordered from least to most recently active
+    for evict_active.  Character actions are logged through 'activity',
+    ranked by count this poll.  Return itemlog_active, and the (character,
+    action) counters updated for update_gauges.
     """
+    if activity is None:
+        activity = activity_log.ActivityLog()
+    time_now = time.time()
+
     # Create itemlog_active keys for new characters
     characters_new = itemlog_db.keys() - itemlog_active.keys()
     for character in characters_new:
-        logging.info('Character %s is new, adding to itemlog_active', character)
+        if activity.verbose:
+            logging.info('Character %s is new, adding to itemlog_active', character)
         itemlog_active[character] = {
             'id': itemlog_db[character]['id'],
-            'action': {}
+            'action': {},
+            'last_seen': time_now
             }
-        for action in action_keys:
-            itemlog_active[character]['action'][action] = {
-                'week': 0,
-                'day': 0,
-                'hour': 0,
-                'consecutive': 0,
-                'now': 0
-                }
-
-    # Update itemlog_active state and gauges
-    for character in itemlog_active:
+
+    # Move active characters to the most recently active end
+    for character in itemlog_db:
+        itemlog_active[character] = itemlog_active.pop(character)
+        itemlog_active[character]['last_seen'] = time_now
+
+    # Update itemlog_active state
+    updated = []
+    for character, character_active in itemlog_active.items():
         # Itemlog character is active if character has entries in itemlog_db
         if character in itemlog_db:
-            for action in itemlog_active[character]['action']:
-                for counter in ['week', 'day', 'hour', 'consecutive', 'now']:
-                    itemlog_active[character]['action'][action][counter] += itemlog_db[character]['action'][action]
-
-                if itemlog_active[character]['action'][action]['now'] != 0:
-                    logging.info(
-                        '{character:25} {action:20} c:{consecutive:3} h:{hour:3} d:{day:3} w:{week:3}'.format(
-                            character=character,
-                            action=gauges[action]._name,
-                            consecutive=itemlog_active[character]['action'][action]['consecutive'],
-                            hour=itemlog_active[character]['action'][action]['hour'],
-                            day=itemlog_active[character]['action'][action]['day'],
-                            week=itemlog_active[character]['action'][action]['week']
-                            )
-                        )
+            for action, count in itemlog_db[character]['action'].items():
+                try:
+                    counters = character_active['action'][action]
+                except KeyError:
+                    counters = character_active['action'][action] = array('l', [0] * len(COUNTERS))
+                for window in ['week', 'day', 'hour']:
+                    # Restart counters last incremented in an earlier epoch
+                    if counters[COUNTERS[window + '_epoch']] != epochs[window]:
+                        counters[COUNTERS[window + '_epoch']] = epochs[window]
+                        counters[COUNTERS[window]] = 0
+                    counters[COUNTERS[window]] += count
+                counters[COUNTERS['consecutive']] += count
+                counters[COUNTERS['now']] += count
+                updated.append((character, action))
+
+                activity.add(count, (character, action))
         # Set consecutive and new gauges to 0 for inactive characters
         else:
-            for action in itemlog_active[character]['action']:
-                for counter in ['consecutive', 'now']:
-                    itemlog_active[character]['action'][action][counter] = 0
+            for action, counters in character_active['action'].items():
+                if counters[COUNTERS['now']] != 0:
+                    counters[COUNTERS['consecutive']] = 0
+                    counters[COUNTERS['now']] = 0
+                    updated.append((character, action))
+
+    activity.flush(
+        functools.partial(format_activity, itemlog_active, epochs),
+        '%s characters active, %s new',
+        len(itemlog_db),
+        len(characters_new)
+        )
+
+    return itemlog_active, updated
 
-        # Update itemlog gauges
-        for action in action_keys:
+
+def update_gauges(itemlog_active, updated, gauges, drop_zero=False):
+    """
+    Update itemlog gauges of the counters updated by update_active,
+    optionally dropping zero-valued series.
+    """
+    for character, action in updated:
+        now = itemlog_active[character]['action'][action][COUNTERS['now']]
+        if drop_zero and now == 0:
+            remove_series(gauges[action], character)
+        else:
             gauges[action].labels(
                 character=character
-                ).set(itemlog_active[character]['action'][action]['now'])
+                ).set(now)
 
-    return itemlog_active
+
+def remove_series(gauge, character):
+    """
+    Remove character series from gauge, if it exists.
+    """
+    try:
+        gauge.remove(character)
+    except KeyError:
+        pass
 
 
-def reset_active(itemlog_active, last_reset, action_keys):
+def evict_active(itemlog_active, gauges, eviction_ttl, eviction_max_characters, verbose=True):
     """
-    Reset itemlog_active active counters.
+    Evict characters idle longer than eviction_ttl seconds, and the least
+    recently active characters beyond eviction_max_characters, from
+    itemlog_active and gauges.  Either limit is disabled when 0.
     """
-    # Set current time
-    time_now = datetime.datetime.now()
+    time_now = time.time()
+
+    # itemlog_active is ordered least recently active first, stop at the first character kept
+    characters_evicted = []
+    for character in itemlog_active:
+        if eviction_ttl and time_now - itemlog_active[character]['last_seen'] > eviction_ttl:
+            characters_evicted.append(character)
+        elif eviction_max_characters and len(itemlog_active) - len(characters_evicted) > eviction_max_characters:
+            characters_evicted.append(character)
+        else:
+            break
 
-    # Reset week, day, & hour if week rollover
-    if time_now - datetime.timedelta(weeks=1) > last_reset['week']:
-        logging.info('Resetting week, day, and hour counters')
-        last_reset['week'] = time_now
-        last_reset['day'] = time_now
-        last_reset['hour'] = time_now
+    for character in characters_evicted:
+        if verbose:
+            logging.info('Character %s is idle, evicting from itemlog_active', character)
+        if gauges is not None:
+            for action in itemlog_active[character]['action']:
+                remove_series(gauges[action], character)
+        del itemlog_active[character]
+    if characters_evicted and not verbose:
+        logging.info('Evicted %s idle characters', len(characters_evicted))
+
+    return itemlog_active
 
-        for character in itemlog_active:
-            for action in action_keys:
-                itemlog_active[character]['action'][action]['week'] = 0
-                itemlog_active[character]['action'][action]['day'] = 0
-                itemlog_active[character]['action'][action]['hour'] = 0
 
-    # Reset day & hour if day rollover
-    elif time_now - datetime.timedelta(days=1) > last_reset['day']:
-        logging.info('Resetting day and hour counters')
-        last_reset['day'] = time_now
-        last_reset['hour'] = time_now
+def reset_active(itemlog_active, last_reset):
+    """
+    Advance itemlog_active active counters to the current week, day, and hour.
+    Counters are tagged with the epoch they count and restart lazily, so
+    rollover costs the same regardless of the number of characters.
+    """
+    epochs = poll_scheduler.window_epochs(datetime.datetime.now())
+    for window in ['week', 'day', 'hour']:
+        if epochs[window] != last_reset[window]:
+            logging.info('Rolling over %s counters', window)
 
-        for character in itemlog_active:
-            for action in action_keys:
-                itemlog_active[character]['action'][action]['day'] = 0
-                itemlog_active[character]['action'][action]['hour'] = 0
+    return itemlog_active, epochs
 
-    # Reset hour if hour rollover
-    elif time_now - datetime.timedelta(hours=1) > last_reset['hour']:
-        logging.info('Resetting hour counter')
-        last_reset['hour'] = time_now
 
-        for character in itemlog_active:
-            for action in action_keys:
-                itemlog_active[character]['action'][action]['hour'] = 0
+class ItemlogCollector:
+    """
+    Prometheus collector rendering itemlog action gauges from itemlog_active
+    at scrape time, in place of per-poll gauge updates.
+    """
+    def __init__(self, itemlog_active, lock, drop_zero=False):
+        self.itemlog_active = itemlog_active
+        self.lock = lock
+        self.drop_zero = drop_zero
+
+    def collect(self):
+        """
+        Yield one gauge family per itemlog action.
+        """
+        families = {
+            action: prometheus_client.core.GaugeMetricFamily(
+                name=name,
+                documentation=documentation,
+                labels=['character']
+                )
+            for action, (name, documentation) in ACTIONS.items()
+            }
+        with self.lock:
+            for character, character_active in self.itemlog_active.items():
+                for action, counters in character_active['action'].items():
+                    if counters[COUNTERS['now']] != 0 or not self.drop_zero:
+                        families[action].add_metric([character], counters[COUNTERS['now']])
 
-    return itemlog_active, last_reset
+        yield from families.values()
 
 
-def monitor_itemlog(db_hostname, db_username, db_password, db_database, poll_interval):
+def setup_itemlog(pool, poll_interval, poll_phase, batch_size, watermark_file, collector_mode,
+                  eviction_ttl, eviction_max_characters, drop_zero, state_file, state_interval,
+                  log_verbosity, log_top_n, log_anomaly_threshold, pipeline,
+                  query_timeout, breaker_failures, breaker_reset,
+                  registry=prometheus_client.REGISTRY):
     """
-    Monitor active characters with reference to changing map positions.
+    Define metrics and initialize itemlog_active, restoring it from
+    state_file if stored.  Return the monitor state polled by poll_itemlog,
+    its metrics registered in registry.
     """
-    # Define gauges
-    gauges = {
-        0: prometheus_client.Gauge(
-            name='item_drop',
-            documentation='Items removed by character drop',
-            labelnames=['character']
-            ),
-        1: prometheus_client.Gauge(
-            name='item_pickup',
-            documentation='Items created by character pickup',
-            labelnames=['character']
-            ),
-        2: prometheus_client.Gauge(
-            name='item_consumed',
-            documentation='Items consumed by character',
-            labelnames=['character']
-            ),
-        3: prometheus_client.Gauge(
-            name='item_traded',
-            documentation='Items traded between characters',
-            labelnames=['character']
-            ),
-        4: prometheus_client.Gauge(
-            name='item_bought_pc',
-            documentation='Items moved by purchase from PC',
-            labelnames=['character']
-            ),
-        5: prometheus_client.Gauge(
-            name='item_bought_npc',
-            documentation='Items created by purchase from NPC',
-            labelnames=['character']
-            ),
-        6: prometheus_client.Gauge(
-            name='item_sold_npc',
-            documentation='Items consumed by sell to NPC',
-            labelnames=['character']
-            ),
-        7: prometheus_client.Gauge(
-            name='item_mvp',
-            documentation='Items created by MVP rewards',
-            labelnames=['character']
-            ),
-        8: prometheus_client.Gauge(
-            name='item_stolen',
-            documentation='Items created by steal',
-            labelnames=['character']
-            ),
-        9: prometheus_client.Gauge(
-            name='item_misc_1',
-            documentation='Items consumed by misc_1 e.g. endow skills, pet capture, etc.',
-            labelnames=['character']
-            ),
-        10: prometheus_client.Gauge(
-            name='item_misc_2',
-            documentation='N/A',
-            labelnames=['character']
-            ),
-        11: prometheus_client.Gauge(
-            name='item_npc_compulsive',
-            documentation='Items created by compulsive NPCs',
-            labelnames=['character']
-            ),
-        12: prometheus_client.Gauge(
-            name='item_npc_event',
-            documentation='Items created by event NPCs',
-            labelnames=['character']
-            ),
-        13: prometheus_client.Gauge(
-            name='item_gm',
-            documentation='Items created by GMs using /item',
-            labelnames=['character']
-            ),
-        14: prometheus_client.Gauge(
-            name='item_box',
-            documentation='Items created by OCAs, OPBs, OBBs, etc.',
-            labelnames=['character']
-            ),
-        15: prometheus_client.Gauge(
-            name='item_blacksmith',
-            documentation='Items created by Blacksmiths',
-            labelnames=['character']
-            ),
-        16: prometheus_client.Gauge(
-            name='item_npc_give',
-            documentation='Items created by NPC e.g. quest',
-            labelnames=['character']
-            ),
-        17: prometheus_client.Gauge(
-            name='item_npc_take',
-            documentation='Items consumed by NPC e.g. quest, refine, etc.',
-            labelnames=['character']
-            ),
-        18: prometheus_client.Gauge(
-            name='zeny_npc',
-            documentation='Zeny consumed/created by NPC',
-            labelnames=['character']
-            ),
-        19: prometheus_client.Gauge(
-            name='item_inv_to_kafra',
-            documentation='Items moved to Kafra storage from character inventory',
-            labelnames=['character']
-            ),
-        20: prometheus_client.Gauge(
-            name='item_inv_to_cart',
-            documentation='Items moved to Cart from character inventory',
-            labelnames=['character']
-            ),
-        21: prometheus_client.Gauge(
-            name='item_kafra_to_inv',
-            documentation='Items moved to character inventory from Kafra storage',
-            labelnames=['character']
-            ),
-        22: prometheus_client.Gauge(
-            name='item_kafra_to_cart',
-            documentation='Items moved to Kafra storage from character cart',
-            labelnames=['character']
-            ),
-        23: prometheus_client.Gauge(
-            name='item_cart_to_inv',
-            documentation='Items moved to character cart from character inventory money',
-            labelnames=['character']
-            ),
-        24: prometheus_client.Gauge(
-            name='item_cart_to_kafra',
-            documentation='Items moved to character cart from Kafra storage',
-            labelnames=['character']
-            ),
-        35: prometheus_client.Gauge(
-            name='item_cash_buy',
-            documentation='Items created by purchase from cashshop NPC',
-            labelnames=['character']
+    # Define gauges, collector mode renders them from itemlog_active at scrape time instead
+    if collector_mode:
+        gauges = None
+    else:
+        gauges = {
+            action: prometheus_client.Gauge(
+                name=name,
+                documentation=documentation,
+                labelnames=['character'],
+                registry=registry
+                )
+            for action, (name, documentation) in ACTIONS.items()
+            }
+
+    # Define cardinality gauge
+    tracked_gauge = prometheus_client.Gauge(
+        name='itemlog_tracked_characters',
+        documentation='# of characters tracked in itemlog_active',
+        registry=registry
+        )
+
+    # Define database histograms
+    histograms = {
+        'connect': prometheus_client.Histogram(
+            name='itemlog_db_connect_seconds',
+            documentation='Time spent opening the database connection',
+            registry=registry
             ),
-        36: prometheus_client.Gauge(
-            name='item_cash_box',
-            documentation='Items created by a cashshop box',
-            labelnames=['character']
+        'query': prometheus_client.Histogram(
+            name='itemlog_db_query_seconds',
+            documentation='Time spent executing rocp_admin_itemlog_db',
+            registry=registry
             )
         }
 
-    # Set reset rollover timestamps, last monday, midnight, last hour
-    time_now = datetime.datetime.now()
-    last_reset = {
-        'week': time_now - datetime.timedelta(days=time_now.weekday()),
-        'day': time_now.replace(hour=0, minute=0, second=0, microsecond=0),
-        'hour': time_now.replace(minute=0, second=0, microsecond=0)
+    # Define activity log, anomalies are character actions performed 'log_anomaly_threshold' times in a poll
+    activity = activity_log.ActivityLog(
+        verbosity=log_verbosity,
+        top_n=log_top_n,
+        anomaly_threshold=log_anomaly_threshold
+        )
+
+    # Set current week, day, and hour counter epochs
+    last_reset = poll_scheduler.window_epochs(datetime.datetime.now())
+
+    # Initalize itemlog_active, restoring it from the last saved state
+    itemlog_active, state_watermark = {}, None
+    if state_file:
+        itemlog_active, state_watermark = restore_active(state_file=state_file, gauges=gauges, drop_zero=drop_zero)
+    itemlog_lock = threading.Lock()
+    if collector_mode:
+        registry.register(ItemlogCollector(itemlog_active, itemlog_lock, drop_zero))
+
+    # Resume incremental polling from the persisted watermark, stored with the counters when state_file is set,
+    # else in watermark_file, e.g. on the first start after setting state_file
+    incremental = bool(watermark_file)
+    watermark = None
+    if incremental:
+        watermark = state_watermark if state_watermark is not None else load_watermark(watermark_file)
+        logging.info('Polling itemlog incrementally from watermark %s', watermark)
+
+    # Define circuit breaker, serving the last snapshot while the database is failing
+    breaker = aegis_db.CircuitBreaker(
+        prefix='itemlog',
+        failures=breaker_failures,
+        reset_timeout=breaker_reset,
+        registry=registry
+        )
+
+    # Define memory accounting of monitor state and gauge children, served at /memory once
+    # the state is restored so a failed setup leaves no account behind
+    memory = memory_accounting.MemoryAccounting(
+        prefix='itemlog',
+        metrics={name: gauges[action] for action, (name, _) in ACTIONS.items()} if gauges is not None else {},
+        registry=registry
+        )
+
+    # Schedule polls on wall-clock ticks
+    scheduler = poll_scheduler.PollScheduler(
+        prefix='itemlog',
+        interval=poll_interval,
+        phase=poll_phase,
+        registry=registry
+        )
+
+    return {
+        'pool': pool,
+        'poll_interval': poll_interval,
+        'scheduler': scheduler,
+        'pipeline': pipeline,
+        'query_timeout': query_timeout,
+        'breaker': breaker,
+        'batch_size': batch_size,
+        'watermark_file': watermark_file,
+        'incremental': incremental,
+        'watermark': watermark,
+        'eviction_ttl': eviction_ttl,
+        'eviction_max_characters': eviction_max_characters,
+        'drop_zero': drop_zero,
+        'state_file': state_file,
+        'state_interval': state_interval,
+        'gauges': gauges,
+        'tracked_gauge': tracked_gauge,
+        'histograms': histograms,
+        'activity': activity,
+        'memory': memory,
+        'itemlog_active': itemlog_active,
+        'last_reset': last_reset,
+        'last_save': time.time(),
+        'lock': itemlog_lock
+        }
+
+
+def fetch_itemlog(monitor):
+    """
+    Return itemlog_db fetched from the database and its watermark, for
+    process_itemlog, or None if the fetch failed or the circuit breaker is open.
+    """
+    scheduler = monitor['scheduler']
+    breaker = monitor['breaker']
+    if not breaker.allow():
+        return None
+
+    # Generate new itemlog_db from database, each query bounded by query_timeout,
+    # the next fetch resumes from its watermark or retries from the last after a failure
+    try:
+        with scheduler.time_phase('fetch'), monitor['pool'].acquire(
+                monitor['histograms'], monitor['query_timeout']) as connection:
+            itemlog_db, monitor['watermark'] = gen_itemlog_db(
+                connection=connection,
+                action_keys=ACTIONS.keys(),
+                poll_interval=monitor['poll_interval'],
+                batch_size=monitor['batch_size'],
+                watermark=monitor['watermark'],
+                incremental=monitor['incremental']
+                )
+    except aegis_db.QUERY_ERRORS as error:
+        breaker.failure(error)
+        return None
+    breaker.success()
+
+    return itemlog_db, monitor['watermark']
+
+
+def process_itemlog(monitor, fetched):
+    """
+    Update monitor state and metrics from a fetched itemlog_db and its
+    watermark, timing each phase.  The watermark is persisted only once its
+    itemlog_db is processed, with the state when state_file is set.  Metrics
+    keep serving the last snapshot if none was fetched.
+    """
+    scheduler = monitor['scheduler']
+    if fetched is None:
+        return
+    itemlog_db, watermark = fetched
+
+    with monitor['lock']:
+        # Advance counters to the current week, day, and hour
+        with scheduler.time_phase('reset'):
+            monitor['itemlog_active'], monitor['last_reset'] = reset_active(
+                itemlog_active=monitor['itemlog_active'],
+                last_reset=monitor['last_reset']
+                )
+
+        # Update itemlog_active characters
+        with scheduler.time_phase('update'):
+            monitor['itemlog_active'], updated = update_active(
+                itemlog_active=monitor['itemlog_active'],
+                itemlog_db=itemlog_db,
+                epochs=monitor['last_reset'],
+                activity=monitor['activity']
+                )
+
+        # Update gauges, collector mode renders them at scrape time instead
+        if monitor['gauges'] is not None:
+            with scheduler.time_phase('gauges'):
+                update_gauges(
+                    itemlog_active=monitor['itemlog_active'],
+                    updated=updated,
+                    gauges=monitor['gauges'],
+                    drop_zero=monitor['drop_zero']
+                    )
+
+        # Evict idle characters
+        with scheduler.time_phase('evict'):
+            monitor['itemlog_active'] = evict_active(
+                itemlog_active=monitor['itemlog_active'],
+                gauges=monitor['gauges'],
+                eviction_ttl=monitor['eviction_ttl'],
+                eviction_max_characters=monitor['eviction_max_characters'],
+                verbose=monitor['activity'].verbose
+                )
+        monitor['tracked_gauge'].set(len(monitor['itemlog_active']))
+
+        # Account memory of monitor state and the fetched rows
+        with scheduler.time_phase('account'):
+            monitor['memory'].account(
+                structures={
+                    'itemlog_active': monitor['itemlog_active'],
+                    'itemlog_db': itemlog_db
+                    }
+                )
+
+        # Persist state every 'state_interval' seconds, atomically with the watermark of the rows it counts
+        if monitor['state_file'] and time.time() - monitor['last_save'] >= monitor['state_interval']:
+            with scheduler.time_phase('save'):
+                aegis_db.save_state(
+                    monitor['state_file'],
+                    STATE_VERSION,
+                    {
+                        'itemlog_active': monitor['itemlog_active'],
+                        'watermark': watermark if monitor['incremental'] else None
+                        }
+                    )
+            monitor['last_save'] = time.time()
+
+    # Without state_file only the watermark is persisted, after every poll
+    if monitor['incremental'] and not monitor['state_file'] and watermark is not None:
+        with scheduler.time_phase('save'):
+            save_watermark(monitor['watermark_file'], watermark)
+
+
+def poll_itemlog(monitor):
+    """
+    Poll the database once, updating monitor state and metrics.
+    """
+    process_itemlog(monitor, fetch_itemlog(monitor))
+
+
+def config_from_env(prefix=''):
+    """
+    Return setup_itemlog arguments from environment variables, optionally prefixed e.g. ITEMLOG_.
+    """
+    poll_interval = int(os.getenv(prefix + 'POLL_INTERVAL'))
+    return {
+        'poll_interval': poll_interval,
+        'poll_phase': float(os.getenv(prefix + 'POLL_PHASE', '0')),
+        'batch_size': int(os.getenv(prefix + 'BATCH_SIZE')),
+        'watermark_file': str(os.getenv(prefix + 'WATERMARK_FILE', '')),
+        'collector_mode': bool(os.getenv(prefix + 'COLLECTOR_MODE')),
+        'eviction_ttl': int(os.getenv(prefix + 'EVICTION_TTL')),
+        'eviction_max_characters': int(os.getenv(prefix + 'EVICTION_MAX_CHARACTERS')),
+        'drop_zero': bool(os.getenv(prefix + 'DROP_ZERO')),
+        'state_file': str(os.getenv(prefix + 'STATE_FILE', '')),
+        'state_interval': int(os.getenv(
+            prefix + 'STATE_INTERVAL',
+            str(aegis_db.STATE_INTERVAL_POLLS * poll_interval)
+            )),
+        'log_verbosity': str(os.getenv(prefix + 'LOG_VERBOSITY', 'all')),
+        'log_top_n': int(os.getenv(prefix + 'LOG_TOP_N', '10')),
+        'log_anomaly_threshold': int(os.getenv(prefix + 'LOG_ANOMALY_THRESHOLD', '100')),
+        'pipeline': bool(os.getenv(prefix + 'PIPELINE')),
+        'query_timeout': int(os.getenv(prefix + 'QUERY_TIMEOUT', '0')),
+        'breaker_failures': int(os.getenv(prefix + 'BREAKER_FAILURES', '3')),
+        'breaker_reset': int(os.getenv(prefix + 'BREAKER_RESET', '300'))
         }
 
-    # Initalize itemlog_active
-    itemlog_active = {}
 
-    # Begin monitor loop
+# Runner plugin entry points, see m_runner
+PLUGIN = {
+    'config': config_from_env,
+    'setup': setup_itemlog,
+    'poll': poll_itemlog,
+    'fetch': fetch_itemlog,
+    'process': process_itemlog,
+    'database': True
+    }
+
+
+def run_itemlog(monitor):
+    """
+    Poll monitor on its scheduler's ticks forever.
+    """
+    # Pipelined mode fetches each poll while the last is processed
+    if monitor['pipeline']:
+        poll_scheduler.run_pipelined(monitor['scheduler'], fetch_itemlog, process_itemlog, monitor)
     while True:
-        # Generate new itemlog_db from database
-        itemlog_db = gen_itemlog_db(
-            server=db_hostname,
-            username=db_username,
-            password=db_password,
-            database=db_database,
-            action_keys=gauges.keys(),
-            poll_interval=poll_interval
-            )
+        monitor['scheduler'].wait()
+        monitor['scheduler'].profiled(poll_itemlog, monitor)
+        logging.info('Iteration complete, sleeping %.0f seconds', monitor['scheduler'].finish())
 
-        # Update itemlog_active characters
-        itemlog_active = update_active(
-            itemlog_active=itemlog_active,
-            itemlog_db=itemlog_db,
-            gauges=gauges,
-            action_keys=gauges.keys()
-            )
 
-        # Prepare for next iteration
-        itemlog_active, last_reset = reset_active(
-            itemlog_active=itemlog_active,
-            last_reset=last_reset,
-            action_keys=gauges.keys()
+def monitor_itemlog(db_driver, db_hostname, db_username, db_password, db_database, db_shards,
+                    poll_interval, poll_phase, batch_size, watermark_file, collector_mode,
+                    eviction_ttl, eviction_max_characters, drop_zero, state_file, state_interval,
+                    log_verbosity, log_top_n, log_anomaly_threshold, pipeline, query_timeout,
+                    breaker_failures, breaker_reset):
+    """
+    Monitor active characters with reference to changing map positions,
+    of each of db_shards concurrently if given.
+    """
+    activity_log.start_queue_logging()
+
+    config = {
+        'poll_interval': poll_interval,
+        'poll_phase': poll_phase,
+        'batch_size': batch_size,
+        'watermark_file': watermark_file,
+        'collector_mode': collector_mode,
+        'eviction_ttl': eviction_ttl,
+        'eviction_max_characters': eviction_max_characters,
+        'drop_zero': drop_zero,
+        'state_file': state_file,
+        'state_interval': state_interval,
+        'log_verbosity': log_verbosity,
+        'log_top_n': log_top_n,
+        'log_anomaly_threshold': log_anomaly_threshold,
+        'pipeline': pipeline,
+        'query_timeout': query_timeout,
+        'breaker_failures': breaker_failures,
+        'breaker_reset': breaker_reset
+        }
+
+    # Poll each shard from its own thread, with its own connection pool, state files, and metrics
+    if db_shards:
+        aegis_db.run_shards(
+            setup_itemlog, run_itemlog, db_shards, db_driver, db_username, config,
+            files=['state_file', 'watermark_file']
             )
 
-        logging.info('Iteration complete, sleeping %s seconds', poll_interval)
-        time.sleep(poll_interval)
+    # Define database connection pool, its connection is opened on first use and kept open
+    pool = aegis_db.ConnectionPool(
+        driver=db_driver,
+        server=db_hostname,
+        username=db_username,
+        password=db_password,
+        database=db_database
+        )
+    run_itemlog(setup_itemlog(pool=pool, **config))
 
 
 if __name__ == '__main__':
-    POLL_INTERVAL = int(os.getenv('POLL_INTERVAL'))
     PROMETHEUS_PORT = int(os.getenv('PROMETHEUS_PORT'))
+    DB_DRIVER = str(os.getenv('DB_DRIVER', 'mssql'))
     DB_HOSTNAME = str(os.getenv('DB_HOSTNAME'))
     DB_DATABASE = str(os.getenv('DB_DATABASE'))
     DB_USERNAME = str(os.getenv('DB_USERNAME'))
-    DB_PASSWORD = open('/run/secrets/DB_PASSWORD').read()
+    DB_PASSWORD = open('/run/secrets/DB_PASSWORD').read() if DB_DRIVER == 'mssql' else ''
+    DB_SHARDS = aegis_db.parse_shards(str(os.getenv('DB_SHARDS', '')), DB_PASSWORD)
 
+    PROFILE_POLLS = int(os.getenv('PROFILE_POLLS', '5'))
+    PROFILE_DIR = str(os.getenv('PROFILE_DIR', '/tmp'))
+
+    MEMORY_PORT = int(os.getenv('MEMORY_PORT', '0'))
+    TRACEMALLOC_FRAMES = int(os.getenv('TRACEMALLOC_FRAMES', '0'))
+
+    memory_accounting.start_memory_server(MEMORY_PORT, TRACEMALLOC_FRAMES)
+    poll_scheduler.profile_on_signal(PROFILE_POLLS, PROFILE_DIR)
     prometheus_client.start_http_server(PROMETHEUS_PORT)
     monitor_itemlog(
+        db_driver=DB_DRIVER,
         db_hostname=DB_HOSTNAME,
         db_username=DB_USERNAME,
         db_password=DB_PASSWORD,
         db_database=DB_DATABASE,
-        poll_interval=POLL_INTERVAL
+        db_shards=DB_SHARDS,
+        **config_from_env()
         )
-
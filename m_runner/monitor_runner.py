@@ -0,0 +1,173 @@
+"""
+Single-process runner for the Aegis monitors.
+Loads any subset of m_active, m_itemlog, and m_tls_expiry as plugins in
+one interpreter, sharing one Prometheus metrics server, one asyncio
+scheduler polling each monitor at its own interval, and one database
+connection pool.  Blocking database polls run in a thread pool, pipelined
+monitors fetch each poll while the last is processed.
+"""
+import asyncio
+import concurrent.futures
+import functools
+import importlib
+import logging
+import os
+import sys
+import prometheus_client
+
+# aegis_db, activity_log, memory_accounting, and poll_scheduler are shared by the monitors from m_common
+MONITORS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(MONITORS_PATH, 'm_common'))
+import activity_log  # noqa: E402
+import aegis_db  # noqa: E402
+import memory_accounting  # noqa: E402
+import poll_scheduler  # noqa: E402
+
+if bool(os.getenv('DEBUG')):
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.DEBUG)
+else:
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+
+# Monitor directory, module, and environment variable prefix, keyed by MONITORS entry
+MONITORS = {
+    'active': ('m_active', 'monitor_active', 'ACTIVE_'),
+    'itemlog': ('m_itemlog', 'monitor_itemlog', 'ITEMLOG_'),
+    'tls_expiry': ('m_tls_expiry', 'monitor_tls_expiry', 'TLS_')
+    }
+
+
+def load_plugin(name):
+    """
+    Import monitor 'name' from its directory and return its PLUGIN entry points.
+    """
+    directory, module, _ = MONITORS[name]
+    path = os.path.join(MONITORS_PATH, directory)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+    return importlib.import_module(module).PLUGIN
+
+
+async def schedule_monitor(name, plugin, monitor, executor):
+    """
+    Poll monitor on its scheduler's ticks, logging rather than raising poll errors.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        await monitor['scheduler'].wait_async()
+        try:
+            if asyncio.iscoroutinefunction(plugin['poll']):
+                await monitor['scheduler'].profiled_async(plugin['poll'], monitor)
+            else:
+                await loop.run_in_executor(executor, monitor['scheduler'].profiled, plugin['poll'], monitor)
+        except Exception:  # pylint: disable=broad-except
+            logging.exception('%s poll failed', name)
+        logging.info('%s iteration complete, sleeping %.0f seconds', name, monitor['scheduler'].finish())
+
+
+async def schedule_pipelined(name, plugin, monitor, executor):
+    """
+    Fetch monitor on its scheduler's ticks while the last fetch is processed,
+    a fetch waiting for processing to catch up skips the ticks it misses.
+    """
+    loop = asyncio.get_running_loop()
+    fetched_queue = asyncio.Queue(maxsize=1)
+
+    async def fetch_loop():
+        while True:
+            await monitor['scheduler'].wait_async()
+            try:
+                await fetched_queue.put(await loop.run_in_executor(executor, plugin['fetch'], monitor))
+            except Exception:  # pylint: disable=broad-except
+                logging.exception('%s fetch failed', name)
+            logging.info('%s fetch complete, sleeping %.0f seconds', name, monitor['scheduler'].finish())
+
+    async def process_loop():
+        while True:
+            fetched = await fetched_queue.get()
+            try:
+                await loop.run_in_executor(
+                    executor, monitor['scheduler'].profiled, plugin['process'], monitor, fetched
+                    )
+            except Exception:  # pylint: disable=broad-except
+                logging.exception('%s process failed', name)
+            logging.info('%s iteration complete', name)
+
+    await asyncio.gather(fetch_loop(), process_loop())
+
+
+async def monitor_runner(plugins, db_driver, db_hostname, db_username, db_password, db_database,
+                         db_pool_size):
+    """
+    Set up and poll monitors until cancelled.
+    """
+    loop = asyncio.get_running_loop()
+    # Two workers per monitor, so a pipelined monitor fetches and processes concurrently
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=2 * len(plugins))
+
+    # Define database connection pool shared by database monitors, connections are opened on first use
+    pool = aegis_db.ConnectionPool(
+        driver=db_driver,
+        server=db_hostname,
+        username=db_username,
+        password=db_password,
+        database=db_database,
+        size=db_pool_size
+        )
+
+    # Set up and poll a monitor, database monitors initialize from the database in the thread pool.
+    # A failed setup is logged and retried after SHARD_RESTART_DELAY seconds, the other monitors
+    # polling meanwhile.  Each attempt registers its metrics in a fresh registry, exposed once set up.
+    async def setup_monitor(name, plugin):
+        while True:
+            registry = prometheus_client.CollectorRegistry()
+            try:
+                config = plugin['config'](MONITORS[name][2])
+                if plugin['database']:
+                    monitor = await loop.run_in_executor(
+                        executor, functools.partial(plugin['setup'], pool=pool, registry=registry, **config)
+                        )
+                else:
+                    monitor = plugin['setup'](registry=registry, **config)
+                break
+            except Exception:  # pylint: disable=broad-except
+                logging.exception('%s setup failed, retrying in %s seconds', name, aegis_db.SHARD_RESTART_DELAY)
+            await asyncio.sleep(aegis_db.SHARD_RESTART_DELAY)
+        prometheus_client.REGISTRY.register(registry)
+        logging.info('Loaded %s, polling every %s seconds', name, monitor['poll_interval'])
+        schedule = schedule_pipelined if monitor.get('pipeline') else schedule_monitor
+        await schedule(name, plugin, monitor, executor)
+
+    # Set up monitors concurrently, so a slow setup such as m_active's SYNC_PROBES does not delay the others
+    await asyncio.gather(*(setup_monitor(name, plugin) for name, plugin in plugins.items()))
+
+
+if __name__ == '__main__':
+    MONITOR_NAMES = [name.strip() for name in str(os.getenv('MONITORS')).split(',')]
+    PROMETHEUS_PORT = int(os.getenv('PROMETHEUS_PORT'))
+    DB_DRIVER = str(os.getenv('DB_DRIVER', 'mssql'))
+    DB_HOSTNAME = str(os.getenv('DB_HOSTNAME'))
+    DB_DATABASE = str(os.getenv('DB_DATABASE'))
+    DB_USERNAME = str(os.getenv('DB_USERNAME'))
+    DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE'))
+    PROFILE_POLLS = int(os.getenv('PROFILE_POLLS', '5'))
+    PROFILE_DIR = str(os.getenv('PROFILE_DIR', '/tmp'))
+    MEMORY_PORT = int(os.getenv('MEMORY_PORT', '0'))
+    TRACEMALLOC_FRAMES = int(os.getenv('TRACEMALLOC_FRAMES', '0'))
+    PLUGINS = {name: load_plugin(name) for name in MONITOR_NAMES}
+    DB_PASSWORD = ''
+    if DB_DRIVER == 'mssql' and any(plugin['database'] for plugin in PLUGINS.values()):
+        DB_PASSWORD = open('/run/secrets/DB_PASSWORD').read()
+
+    activity_log.start_queue_logging()
+    memory_accounting.start_memory_server(MEMORY_PORT, TRACEMALLOC_FRAMES)
+    poll_scheduler.profile_on_signal(PROFILE_POLLS, PROFILE_DIR)
+    prometheus_client.start_http_server(PROMETHEUS_PORT)
+    asyncio.run(monitor_runner(
+        plugins=PLUGINS,
+        db_driver=DB_DRIVER,
+        db_hostname=DB_HOSTNAME,
+        db_username=DB_USERNAME,
+        db_password=DB_PASSWORD,
+        db_database=DB_DATABASE,
+        db_pool_size=DB_POOL_SIZE
+    ))
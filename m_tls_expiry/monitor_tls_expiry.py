@@ -1,14 +1,29 @@
 """
 TLS certificate expiry monitor
+Hosts are checked concurrently with asyncio, bounded by 'concurrency', with
+per-host connect and handshake timeouts.  Check results are cached, and each
+host is re-checked more often as its certificate nears expiry or after an
+error, and at most every 'recheck_max' seconds otherwise.  Optionally,
+every certificate in the presented chain is inspected, parsing each
+distinct certificate once.
 v1.0.0 Koko - 20/10/24
 """
+import asyncio
+import hashlib
 import socket
 import ssl
 import logging
 import datetime
 import os
+import sys
 import time
 import prometheus_client
+from cryptography import x509
+from cryptography.hazmat.primitives.asymmetric import rsa, dsa, ec
+
+# Modules shared by the monitors
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'm_common'))
+import poll_scheduler  # noqa: E402
 
 if bool(os.getenv('DEBUG')):
     logging.basicConfig(format='%(asctime)s %(message)s', level=logging.DEBUG)
@@ -16,51 +31,349 @@ else:
     logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
 
 
-def check_tls_expiry(host):
-    """Return hostname TLS certificate expiry datetime object."""
-    context = ssl.create_default_context()
-    conn = context.wrap_socket(
-        socket.socket(socket.AF_INET),
-        server_hostname=host[0]
-        )
+# Re-check a certificate after this fraction of its remaining lifetime
+RECHECK_DIVISOR = 10
+
+
+def classify_error(error, stage):
+    """Return a short classification of a TLS check error."""
+    if isinstance(error, asyncio.TimeoutError):
+        return '{}_timeout'.format(stage)
+    if isinstance(error, socket.gaierror):
+        return 'dns'
+    if isinstance(error, ConnectionRefusedError):
+        return 'refused'
+    if isinstance(error, ssl.SSLCertVerificationError):
+        return 'verify'
+    if isinstance(error, ssl.SSLError):
+        return 'tls'
+    if isinstance(error, (ValueError, IndexError)):
+        return 'invalid'
+    return 'network'
+
+
+def peer_chain(ssl_object):
+    """Return DER certificates presented by the peer, leaf first."""
+    # Public from python 3.13, exposed on the underlying _sslobj from 3.10
+    get_chain = getattr(ssl_object, 'get_unverified_chain', None)
+    if get_chain is None:
+        get_chain = getattr(getattr(ssl_object, '_sslobj', None), 'get_unverified_chain', None)
+    if get_chain is None:
+        return [ssl_object.getpeercert(binary_form=True)]
+
+    return [
+        cert if isinstance(cert, bytes) else ssl.PEM_cert_to_DER_cert(cert.public_bytes())
+        for cert in get_chain()
+        ]
+
+
+def parse_certificate(der):
+    """Return subject, issuer, expiry, key size, signature algorithm, and SAN names of a DER certificate."""
+    cert = x509.load_der_x509_certificate(der)
+
+    # not_valid_after is deprecated in favour of the timezone aware not_valid_after_utc
+    not_after = getattr(cert, 'not_valid_after_utc', None)
+    not_after = cert.not_valid_after if not_after is None else not_after.replace(tzinfo=None)
+
+    public_key = cert.public_key()
+    key_size = public_key.key_size if isinstance(
+        public_key,
+        (rsa.RSAPublicKey, dsa.DSAPublicKey, ec.EllipticCurvePublicKey)
+        ) else 0
 
     try:
-        conn.connect((str(host[0]), int(host[1])))
-        tls_info = conn.getpeercert()
-        conn.close()
-
-        # Parse cert to find expiry as datetime obj
-        time_expires = datetime.datetime.strptime(
-            tls_info['notAfter'],
-            r'%b %d %H:%M:%S %Y %Z'
+        san = cert.extensions.get_extension_for_class(x509.SubjectAlternativeName)
+        san_names = san.value.get_values_for_type(x509.DNSName) + [
+            str(address) for address in san.value.get_values_for_type(x509.IPAddress)
+            ]
+    except x509.ExtensionNotFound:
+        san_names = []
+
+    return {
+        'subject': cert.subject.rfc4514_string(),
+        'issuer': cert.issuer.rfc4514_string(),
+        'not_after': not_after,
+        'key_size': key_size,
+        'signature_algorithm': getattr(
+            cert.signature_algorithm_oid,
+            '_name',
+            cert.signature_algorithm_oid.dotted_string
+            ),
+        'san_names': san_names
+        }
+
+
+def san_covers(san_names, hostname):
+    """Return whether a certificate's SAN names cover hostname, allowing left-most label wildcards."""
+    hostname = hostname.lower().rstrip('.')
+    for dns_name in san_names:
+        dns_name = dns_name.lower().rstrip('.')
+        if dns_name == hostname:
+            return True
+        if dns_name.startswith('*.') and '.' in hostname and hostname.split('.', 1)[1] == dns_name[2:]:
+            return True
+    return False
+
+
+async def check_tls_expiry(host, connect_timeout, handshake_timeout, certificates=None):
+    """
+    Return hostname TLS certificate expiry, fingerprints, and error classification or None.
+    Chain certificates not yet in 'certificates' are parsed and added, keyed by fingerprint.
+    A chain failing verification is fetched again unverified, so its certificates are still reported.
+    """
+    loop = asyncio.get_running_loop()
+    # Hostname coverage is checked against the leaf SAN, reported rather than failing the handshake
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context_unverified = ssl.create_default_context()
+    context_unverified.check_hostname = False
+    context_unverified.verify_mode = ssl.CERT_NONE
+    stage = 'connect'
+    result = {'not_after': None, 'fingerprint': None, 'chain': [], 'error': None}
+
+    async def handshake(port, context):
+        """Return DER certificates presented by host, leaf first."""
+        nonlocal stage
+        stage = 'connect'
+        transport, protocol = await asyncio.wait_for(
+            loop.create_connection(asyncio.Protocol, str(host[0]), port),
+            connect_timeout
             )
-    except ConnectionRefusedError:
-        logging.error('Unable to connect to %s:%s', host[0], host[1])
-        time_expires = datetime.datetime.utcnow()
+        try:
+            stage = 'handshake'
+            transport = await asyncio.wait_for(
+                loop.start_tls(transport, protocol, context, server_hostname=host[0]),
+                handshake_timeout
+                )
+            return peer_chain(transport.get_extra_info('ssl_object'))
+        finally:
+            transport.close()
+
+    try:
+        port = int(host[1])
+        try:
+            chain = await handshake(port, context)
+        except ssl.SSLCertVerificationError as exception:
+            result['error'] = classify_error(exception, stage)
+            logging.error('Unable to verify %s:%s (%s): %s', host[0], host[1], result['error'], exception)
+            chain = await handshake(port, context_unverified)
 
-    return time_expires
+        result['chain'] = [hashlib.sha256(cert).hexdigest() for cert in chain]
+        result['fingerprint'] = result['chain'][0]
+        if certificates is not None:
+            for fingerprint, cert in zip(result['chain'], chain):
+                if fingerprint not in certificates:
+                    certificates[fingerprint] = parse_certificate(cert)
+            leaf = certificates[result['fingerprint']]
+        else:
+            leaf = parse_certificate(chain[0])
+        result['not_after'] = leaf['not_after']
 
+        if result['error'] is None and not san_covers(leaf['san_names'], host[0]):
+            result['error'] = 'hostname'
+            logging.error('Unable to verify %s:%s (hostname): SAN %s', host[0], host[1], leaf['san_names'])
+    except (OSError, asyncio.TimeoutError, ValueError, IndexError) as exception:
+        # A chain that could not be parsed is not reported
+        result.update({'not_after': None, 'fingerprint': None, 'chain': []})
+        result['error'] = classify_error(exception, stage)
+        logging.error('Unable to check %s (%s): %s', ':'.join(host), result['error'], exception)
 
-def monitor_tls_expiry(host_string, poll_interval):
-    """Monitor TLS certificates expiry."""
-    # Translate hoststring into sublists
+    return result
+
+
+def next_check_delay(result, time_now, poll_interval, recheck_max):
+    """Return seconds until a host should be re-checked, sooner as its certificate nears expiry."""
+    if result['error'] is not None:
+        return poll_interval
+
+    seconds_remain = (result['not_after'] - time_now).total_seconds()
+    return min(max(seconds_remain / RECHECK_DIVISOR, poll_interval), recheck_max)
+
+
+async def check_tls_expiry_bounded(host, semaphore, connect_timeout, handshake_timeout, histogram,
+                                   certificates=None):
+    """Check host once a semaphore slot is free, observing the check duration."""
+    async with semaphore:
+        time_start = time.perf_counter()
+        result = await check_tls_expiry(host, connect_timeout, handshake_timeout, certificates)
+        histogram.observe(time.perf_counter() - time_start)
+
+    return result
+
+
+def update_chain_gauges(host, result, certificates, chain_gauges, chain_series, time_now):
+    """Set chain inspection gauges of host from its cached result, removing series of a previous chain and SAN match."""
+    series = []
+    for depth, fingerprint in enumerate(result['chain']):
+        certificate = certificates[fingerprint]
+        labels = [host[0], str(depth)]
+        info_labels = labels + [
+            certificate['subject'],
+            certificate['issuer'],
+            certificate['signature_algorithm']
+            ]
+        chain_gauges['expiry'].labels(*labels).set((certificate['not_after'] - time_now).days)
+        chain_gauges['key_size'].labels(*labels).set(certificate['key_size'])
+        chain_gauges['info'].labels(*info_labels).set(1)
+        series.append((labels, info_labels))
+
+    if result['chain']:
+        leaf = certificates[result['chain'][0]]
+        chain_gauges['san_match'].labels(host[0]).set(int(san_covers(leaf['san_names'], host[0])))
+    elif chain_series.get(':'.join(host)):
+        # A host failing its check no longer reports SAN coverage, another port may already have removed it
+        try:
+            chain_gauges['san_match'].remove(host[0])
+        except KeyError:
+            pass
+
+    # Remove series of certificates no longer presented at the same depth
+    for labels, info_labels in chain_series.get(':'.join(host), []):
+        if (labels, info_labels) in series:
+            continue
+        if labels not in [labels_new for labels_new, _ in series]:
+            chain_gauges['expiry'].remove(*labels)
+            chain_gauges['key_size'].remove(*labels)
+        chain_gauges['info'].remove(*info_labels)
+    chain_series[':'.join(host)] = series
+
+
+def setup_tls_expiry(host_string, poll_interval, poll_phase, concurrency, connect_timeout,
+                     handshake_timeout, recheck_max, chain_inspection,
+                     registry=prometheus_client.REGISTRY):
+    """Define metrics in registry and return the monitor state polled by poll_tls_expiry."""
+    # Translate hoststring into sublists, skipping empty entries
     hosts = host_string.split(',')
     hosts = [host.strip(' ') for host in hosts]
-    hosts = [host.split(':') for host in hosts]
+    hosts = [host.split(':') for host in hosts if host]
+    if not hosts:
+        logging.warning('No hosts to check in %r', host_string)
 
-    # Init gauge
+    # Init metrics
     gauge = prometheus_client.Gauge(
         name='tls_expiry',
         documentation='Days until TLS certificate expiry',
-        labelnames=['domain']
+        labelnames=['domain'],
+        registry=registry
+        )
+    histogram = prometheus_client.Histogram(
+        name='tls_check_duration_seconds',
+        documentation='Time spent checking a host TLS certificate',
+        registry=registry
         )
+    errors = prometheus_client.Counter(
+        name='tls_check_errors',
+        documentation='TLS certificate checks failed, by error classification',
+        labelnames=['domain', 'error'],
+        registry=registry
+        )
+    semaphore = asyncio.Semaphore(concurrency)
 
-    while True:
-        # Report TLS certificate expiry for each host
-        time_now = datetime.datetime.utcnow()
+    # Init chain inspection metrics, parsed certificates are cached by fingerprint
+    certificates = None
+    chain_gauges = None
+    chain_series = None
+    if chain_inspection:
+        certificates = {}
+        chain_gauges = {
+            'expiry': prometheus_client.Gauge(
+                name='tls_chain_expiry',
+                documentation='Days until expiry of each certificate in the presented chain',
+                labelnames=['domain', 'depth'],
+                registry=registry
+                ),
+            'key_size': prometheus_client.Gauge(
+                name='tls_chain_key_size',
+                documentation='Public key size in bits of each certificate in the presented chain',
+                labelnames=['domain', 'depth'],
+                registry=registry
+                ),
+            'info': prometheus_client.Gauge(
+                name='tls_chain_info',
+                documentation='Subject, issuer, and signature algorithm of each certificate in the presented chain',
+                labelnames=['domain', 'depth', 'subject', 'issuer', 'signature_algorithm'],
+                registry=registry
+                ),
+            'san_match': prometheus_client.Gauge(
+                name='tls_san_match',
+                documentation='Whether the leaf certificate SAN covers the requested hostname',
+                labelnames=['domain'],
+                registry=registry
+                )
+            }
+        chain_series = {}
+
+    # Schedule polls on wall-clock ticks
+    scheduler = poll_scheduler.PollScheduler(
+        prefix='tls',
+        interval=poll_interval,
+        phase=poll_phase,
+        registry=registry
+        )
+
+    return {
+        'hosts': hosts,
+        'poll_interval': poll_interval,
+        'scheduler': scheduler,
+        'connect_timeout': connect_timeout,
+        'handshake_timeout': handshake_timeout,
+        'recheck_max': recheck_max,
+        'chain_inspection': chain_inspection,
+        'gauge': gauge,
+        'histogram': histogram,
+        'errors': errors,
+        'semaphore': semaphore,
+        'certificates': certificates,
+        'chain_gauges': chain_gauges,
+        'chain_series': chain_series,
+        # Cache of check results and next check time, keyed by host:port
+        'cache': {}
+        }
 
-        for host in hosts:
-            time_expiry = check_tls_expiry(host)
+
+async def poll_tls_expiry(monitor):
+    """Check hosts due for a re-check and report expiry of every host, timing each phase."""
+    cache = monitor['cache']
+    scheduler = monitor['scheduler']
+
+    # Check hosts due for a re-check concurrently.  Polls start a variable lag after
+    # their tick, so a host is due by the poll nearest its next check rather than after it.
+    time_now = datetime.datetime.utcnow()
+    time_due = time_now + datetime.timedelta(seconds=monitor['poll_interval'] / 2)
+    hosts_due = [
+        host for host in monitor['hosts']
+        if ':'.join(host) not in cache or cache[':'.join(host)]['next_check'] <= time_due
+        ]
+    with scheduler.time_phase('check'):
+        results = await asyncio.gather(*[
+            check_tls_expiry_bounded(
+                host,
+                monitor['semaphore'],
+                monitor['connect_timeout'],
+                monitor['handshake_timeout'],
+                monitor['histogram'],
+                monitor['certificates']
+                )
+            for host in hosts_due
+            ])
+
+    for host, result in zip(hosts_due, results):
+        if result['error'] is not None:
+            monitor['errors'].labels(domain=host[0], error=result['error']).inc()
+        elif cache.get(':'.join(host), {}).get('fingerprint') not in (None, result['fingerprint']):
+            logging.info('%s TLS certificate changed to %s', host[0], result['fingerprint'])
+
+        result['next_check'] = time_now + datetime.timedelta(
+            seconds=next_check_delay(result, time_now, monitor['poll_interval'], monitor['recheck_max'])
+            )
+        cache[':'.join(host)] = result
+        logging.debug('%s next TLS check at %s', host[0], result['next_check'])
+
+    # Report TLS certificate expiry for each host from cache, failed checks expire now
+    with scheduler.time_phase('report'):
+        for host in monitor['hosts']:
+            result = cache[':'.join(host)]
+            time_expiry = time_now if result['error'] is not None else result['not_after']
             time_remain = time_expiry - time_now
             logging.info(
                 '%s TLS certificate expires in %s days',
@@ -68,17 +381,71 @@ def monitor_tls_expiry(host_string, poll_interval):
                 time_remain.days
                 )
 
-            gauge.labels(domain=host[0]).set(time_remain.days)
+            monitor['gauge'].labels(domain=host[0]).set(time_remain.days)
+            if monitor['chain_inspection']:
+                update_chain_gauges(
+                    host,
+                    result,
+                    monitor['certificates'],
+                    monitor['chain_gauges'],
+                    monitor['chain_series'],
+                    time_now
+                    )
+
+        # Drop parsed certificates no longer presented by any host
+        if monitor['chain_inspection']:
+            fingerprints = {fingerprint for result in cache.values() for fingerprint in result['chain']}
+            for fingerprint in monitor['certificates'].keys() - fingerprints:
+                del monitor['certificates'][fingerprint]
+
+
+def config_from_env(prefix=''):
+    """Return setup_tls_expiry arguments from environment variables, optionally prefixed e.g. TLS_."""
+    return {
+        'host_string': str(os.getenv(prefix + 'HOST_STRING')),
+        'poll_interval': int(os.getenv(prefix + 'POLL_INTERVAL')),
+        'poll_phase': float(os.getenv(prefix + 'POLL_PHASE', '0')),
+        'concurrency': int(os.getenv(prefix + 'CONCURRENCY')),
+        'connect_timeout': float(os.getenv(prefix + 'CONNECT_TIMEOUT')),
+        'handshake_timeout': float(os.getenv(prefix + 'HANDSHAKE_TIMEOUT')),
+        'recheck_max': int(os.getenv(prefix + 'RECHECK_MAX')),
+        'chain_inspection': bool(os.getenv(prefix + 'CHAIN_INSPECTION'))
+        }
 
-        time.sleep(poll_interval)
+
+# Runner plugin entry points, see m_runner
+PLUGIN = {
+    'config': config_from_env,
+    'setup': setup_tls_expiry,
+    'poll': poll_tls_expiry,
+    'database': False
+    }
+
+
+async def monitor_tls_expiry(host_string, poll_interval, poll_phase, concurrency, connect_timeout,
+                             handshake_timeout, recheck_max, chain_inspection):
+    """Monitor TLS certificates expiry."""
+    monitor = setup_tls_expiry(
+        host_string=host_string,
+        poll_interval=poll_interval,
+        poll_phase=poll_phase,
+        concurrency=concurrency,
+        connect_timeout=connect_timeout,
+        handshake_timeout=handshake_timeout,
+        recheck_max=recheck_max,
+        chain_inspection=chain_inspection
+        )
+
+    while True:
+        await monitor['scheduler'].wait_async()
+        await monitor['scheduler'].profiled_async(poll_tls_expiry, monitor)
+        monitor['scheduler'].finish()
 
 if __name__ == '__main__':
-    HOST_STRING = str(os.getenv('HOST_STRING'))
-    POLL_INTERVAL = int(os.getenv('POLL_INTERVAL'))
     PROMETHEUS_PORT = int(os.getenv('PROMETHEUS_PORT'))
+    PROFILE_POLLS = int(os.getenv('PROFILE_POLLS', '5'))
+    PROFILE_DIR = str(os.getenv('PROFILE_DIR', '/tmp'))
 
+    poll_scheduler.profile_on_signal(PROFILE_POLLS, PROFILE_DIR)
     prometheus_client.start_http_server(PROMETHEUS_PORT)
-    monitor_tls_expiry(
-        host_string=HOST_STRING,
-        poll_interval=POLL_INTERVAL
-    )
+    asyncio.run(monitor_tls_expiry(**config_from_env()))
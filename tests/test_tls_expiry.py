@@ -0,0 +1,52 @@
+"""
+Tests of m_tls_expiry re-check scheduling.
+Requires the m_tls_expiry dependencies, run from the repository root:
+    python3 -m unittest discover tests
+"""
+import asyncio
+import os
+import sys
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'm_tls_expiry'))
+import monitor_tls_expiry  # noqa: E402
+
+POLL_INTERVAL = 0.2
+
+
+class PollTlsExpiryTest(unittest.TestCase):
+    """
+    poll_tls_expiry against a stubbed check, polled directly rather than on scheduler ticks.
+    """
+    def setUp(self):
+        self.monitor = monitor_tls_expiry.setup_tls_expiry(
+            host_string='failing.example:443',
+            poll_interval=POLL_INTERVAL,
+            poll_phase=0,
+            concurrency=1,
+            connect_timeout=1,
+            handshake_timeout=1,
+            recheck_max=3600,
+            chain_inspection=False
+            )
+        self.checks = 0
+
+    async def check_tls_expiry(self, host, connect_timeout, handshake_timeout, certificates=None):
+        self.checks += 1
+        return {'not_after': None, 'fingerprint': None, 'chain': [], 'error': 'refused'}
+
+    def test_error_host_rechecked_next_poll_with_smaller_lag(self):
+        """A host re-checked every poll is due on a poll starting less than an interval after the last."""
+        with mock.patch.object(monitor_tls_expiry, 'check_tls_expiry', self.check_tls_expiry):
+            asyncio.run(monitor_tls_expiry.poll_tls_expiry(self.monitor))
+            # The next poll starts closer to its tick than this one did
+            time.sleep(POLL_INTERVAL * 0.9)
+            asyncio.run(monitor_tls_expiry.poll_tls_expiry(self.monitor))
+
+        self.assertEqual(self.checks, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()